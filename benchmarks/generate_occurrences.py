@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic GBIF SIMPLE_CSV occurrence downloads for benchmarks.
+
+Each species is given a number of sites scattered over the globe and every
+occurrence is placed at one of them, so that, as in real downloads, many
+records share a coordinate or a raster pixel.
+"""
+
+import argparse
+import zipfile
+import numpy as np
+import pandas as pd
+
+HEADER = ['gbifID', 'datasetKey', 'occurrenceID', 'kingdom', 'phylum',
+          'class', 'order', 'family', 'genus', 'species',
+          'infraspecificEpithet', 'taxonRank', 'scientificName', 'countryCode',
+          'locality', 'publishingOrgKey', 'decimalLatitude',
+          'decimalLongitude', 'coordinateUncertaintyInMeters',
+          'coordinatePrecision', 'elevation', 'elevationAccuracy', 'depth',
+          'depthAccuracy', 'eventDate', 'day', 'month', 'year', 'taxonKey',
+          'speciesKey', 'basisOfRecord', 'institutionCode', 'collectionCode',
+          'catalogNumber', 'recordNumber', 'identifiedBy', 'dateIdentified',
+          'license', 'rightsHolder', 'recordedBy', 'typeStatus',
+          'establishmentMeans', 'lastInterpreted', 'mediaType', 'issue']
+FILLER = [''] * len(HEADER)
+FILLER[3] = 'Plantae'
+FILLER[11] = 'SPECIES'
+FILLER[30] = 'HUMAN_OBSERVATION'
+
+def write_rows(target, rng, species_keys, sites, rows):
+    # Writes 'rows' occurrence records to an open binary file.
+    species = rng.integers(len(species_keys), size=rows)
+    site = rng.integers(sites.shape[2], size=rows)
+    lat, lon = sites[0, species, site], sites[1, species, site]
+    uncertainty = rng.choice(np.array(['', '10', '250', '1000', '5000',
+        '30000'], dtype=object), size=rows, p=[.3, .2, .2, .15, .1, .05])
+    prefix = '\t'.join(FILLER[:16]) + '\t'
+    middle = '\t' + '\t'.join(FILLER[19:29]) + '\t'
+    suffix = '\t' + '\t'.join(FILLER[30:]) + '\n'
+    lines = (prefix + pd.Series(lat).round(5).astype(str) + '\t'
+             + pd.Series(lon).round(5).astype(str) + '\t'
+             + pd.Series(uncertainty) + middle
+             + pd.Series(species_keys[species]).astype(str) + suffix)
+    target.write(''.join(lines).encode('utf-8'))
+
+def generate(path, rows, species_keys, member_name='occurrences.csv',
+             sites_per_species=50, chunk_rows=10**6, seed=0):
+    # Writes a zip archive holding a single SIMPLE_CSV file of 'rows' records.
+    rng = np.random.default_rng(seed)
+    species_keys = np.asarray(species_keys)
+    shape = (len(species_keys), sites_per_species)
+    sites = np.stack([rng.uniform(-56, 83, shape),
+                      rng.uniform(-180, 180, shape)])
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(member_name, 'w', force_zip64=True) as target:
+            target.write(('\t'.join(HEADER) + '\n').encode('utf-8'))
+            for start in range(0, rows, chunk_rows):
+                n = min(chunk_rows, rows - start)
+                write_rows(target, rng, species_keys, sites, n)
+
+def read_species_keys(path):
+    with open(path) as f:
+        return [int(line) for line in f.read().splitlines() if line]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=10**6)
+    parser.add_argument('--species-keys', default='data/unique-species-keys.txt')
+    parser.add_argument('--sites-per-species', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.rows, read_species_keys(args.species_keys),
+             sites_per_species=args.sites_per_species, seed=args.seed)
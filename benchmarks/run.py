@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the GINSENG pipeline.
+
+Each task from SearchNuccore to ClassifySequences is run in turn, in its own
+process, against a stub Entrez/GBIF server that replays the sample run in the
+'data' folder. The occurrence downloads are synthetic. The wall time,
+throughput and peak resident set size of every task are reported, after the
+time it takes Luigi to start and load the pipeline.
+
+    python benchmarks/run.py --rows 1000000 -- --ClassifyOccurrences-batch
+
+Arguments after '--' are passed on to Luigi. To compare the streamed hand-off
+from downloads to classification with the two separate stages, limit the
+download bandwidth and skip DownloadOccurrences:
+
+    python benchmarks/run.py --bandwidth 5 --tasks ClassifyOccurrences \
+        -- --ClassifyOccurrences-streamed
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import stub_server
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for line in f)
+
+def output_lines(name):
+    return lambda workdir, rows: count_lines(
+        os.path.join(workdir, 'data', name))
+
+def occurrences(workdir, rows):
+    return rows
+
+def megabytes(workdir, rows):
+    path = os.path.join(workdir, 'data', 'occurrences.zip')
+    return os.path.getsize(path) / 2**20
+
+# Each task with the unit and count of what it processes.
+TASKS = [('SearchNuccore', 'requests', lambda workdir, rows: 1),
+         ('GetNuccoreSummaries', 'summaries',
+             output_lines('nuccore-docsummaries.txt')),
+         ('RemoveDuplicateTaxIDs', 'taxids', output_lines('unique-taxids.txt')),
+         ('PostTaxIDs', 'requests', lambda workdir, rows: 1),
+         ('GetTaxonomySummaries', 'summaries',
+             output_lines('taxonomy-docsummaries.txt')),
+         ('GBIFSpeciesMatch', 'names',
+             output_lines('taxonomy-docsummaries.txt')),
+         ('RemoveDuplicateSpeciesKeys', 'keys',
+             output_lines('unique-species-keys.txt')),
+         ('PostUsageKeys', 'downloads', output_lines('download-IDs.txt')),
+         ('GetDownloadLinks', 'downloads', output_lines('download-links.txt')),
+         ('DownloadOccurrences', 'MB', megabytes),
+         ('ClassifyOccurrences', 'occurrences', occurrences),
+         ('AggregateClassifications', 'occurrences', occurrences),
+         ('ClassifySequences', 'sequences',
+             output_lines('nuccore-docsummaries.txt'))]
+
+def run_task(task, base_url, luigi_args):
+    # Runs one task in a child process and returns its wall time in seconds
+    # and peak resident set size in megabytes.
+    args = [sys.executable, os.path.abspath(__file__), 'task',
+            '--base-url', base_url, task, '--local-scheduler'] + luigi_args
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError('{0} failed:\n{1}'.format(task, stderr.decode()))
+    return seconds, rusage.ru_maxrss / 1024 # Kilobytes on Linux.
+
+def measure_startup(runs):
+    # Returns the median wall time in seconds of a process that starts Luigi,
+    # loads the pipeline module and prints its help, which is the fixed cost
+    # paid by every task worker.
+    args = [sys.executable, '-m', 'luigi', '--module', 'ginseng-pipeline',
+            '--help']
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=REPO_DIR, stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+def prepare(workdir):
+    # Sets up the working directory and returns the folder of stub downloads.
+    downloads_dir = os.path.join(workdir, 'stub-downloads')
+    os.makedirs(downloads_dir, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'k2classes.tif'),
+                os.path.join(workdir, 'data'))
+    return downloads_dir
+
+def generate_downloads(workdir, rows, fixtures):
+    # Generates one synthetic download per download ID requested by
+    # PostUsageKeys, with the occurrences split evenly among them.
+    with open(os.path.join(workdir, 'data', 'download-IDs.txt')) as f:
+        download_ids = f.read().splitlines()
+    print('Generating {0:,} occurrences in {1} downloads'.format(rows,
+        len(download_ids)))
+    downloads_dir = fixtures.downloads_dir
+    species_keys = sorted(set(fixtures.species_keys.values()))
+    jobs = []
+    for i, download_id in enumerate(download_ids):
+        n = rows // len(download_ids) + (i < rows % len(download_ids))
+        path = os.path.join(downloads_dir, download_id + '.zip')
+        jobs.append((path, n, download_id + '.csv', i))
+    # The downloads are written in a fresh process. Task processes inherit
+    # the peak resident set size of this one, so it must not grow by loading
+    # NumPy and pandas or holding the data.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        executor.submit(write_downloads, jobs, species_keys).result()
+
+def write_downloads(jobs, species_keys):
+    # Writes (path, rows, member name, seed) downloads.
+    import generate_occurrences # Loads NumPy and pandas.
+    for path, rows, member_name, seed in jobs:
+        generate_occurrences.generate(path, rows, species_keys,
+            member_name=member_name, seed=seed)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10**6,
+                        help='synthetic occurrences in all downloads')
+    parser.add_argument('--tasks', nargs='+', default=[t[0] for t in TASKS])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every stub response')
+    parser.add_argument('--prepare-time', type=float, default=0,
+                        help='seconds until a stub download succeeds')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='megabytes per second per stub download')
+    parser.add_argument('--workdir', help='kept after the run if given')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='runs to take the median startup time of')
+    parser.add_argument('--output', help='write the results as JSON')
+    if '--' in argv:
+        luigi_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        luigi_args = []
+    args = parser.parse_args(argv)
+
+    startup = measure_startup(args.startup_runs)
+    print('Startup: {0:.2f} seconds'.format(startup))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ginseng-bench-')
+    fixtures = stub_server.Fixtures(os.path.join(REPO_DIR, 'data'), None)
+    print('Working directory: ' + workdir)
+    fixtures.downloads_dir = prepare(workdir)
+    server = stub_server.start_server(fixtures, args.latency,
+                                      args.prepare_time,
+                                      bandwidth=args.bandwidth)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = []
+    try:
+        row = '{0:<28}{1:>10}{2:>16}{3:>14}{4:>12}'
+        print(row.format('Task', 'Seconds', 'Throughput', 'Unit/s',
+                         'Peak RSS MB'))
+        generated = False
+        for task, unit, count in TASKS:
+            if task not in args.tasks:
+                continue
+            if (task in ('DownloadOccurrences', 'ClassifyOccurrences')
+                    and not generated):
+                # ClassifyOccurrences downloads them itself when streamed. The
+                # downloads are generated for the IDs that PostUsageKeys
+                # requests, so it is run first if it was skipped, and their
+                # preparation starts again once they are written.
+                if not os.path.exists(os.path.join('data', 'download-IDs.txt')):
+                    run_task('PostUsageKeys', server.base_url, luigi_args)
+                generate_downloads(workdir, args.rows, fixtures)
+                server.restart_downloads()
+                generated = True
+            requests_before = sum(server.counts.values())
+            seconds, peak_rss = run_task(task, server.base_url, luigi_args)
+            requests = sum(server.counts.values()) - requests_before
+            throughput = count(workdir, args.rows) / seconds
+            print(row.format(task, '{0:.2f}'.format(seconds),
+                             '{0:,.1f}'.format(throughput), unit,
+                             '{0:.0f}'.format(peak_rss)))
+            results.append({'task':task, 'seconds':seconds,
+                            'throughput':throughput, 'unit':unit,
+                            'peak_rss_mb':peak_rss,
+                            'stub_requests':requests})
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'rows':args.rows, 'latency':args.latency,
+                       'bandwidth':args.bandwidth,
+                       'luigi_args':luigi_args, 'startup_seconds':startup,
+                       'results':results}, f, indent=2)
+
+def run_task_in_child(argv):
+    # Points the pipeline at the stub server and runs Luigi.
+    import luigi
+    i = argv.index('--base-url')
+    base_url = argv[i + 1]
+    argv = argv[:i] + argv[i + 2:]
+    sys.argv[0] = 'luigi'
+    pipeline = importlib.import_module('ginseng-pipeline')
+    pipeline.EntrezTask.url = base_url + '/entrez/eutils/'
+    pipeline.GBIFTask.url = base_url + '/v1/'
+    sys.exit(0 if luigi.run(argv) else 1)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['task']:
+        run_task_in_child(sys.argv[2:])
+    else:
+        main(sys.argv[1:])
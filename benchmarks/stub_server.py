@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Stub NCBI Entrez and GBIF server for offline benchmarks.
+
+The responses are replayed from the sample run recorded in the 'data' folder,
+so SearchNuccore through DownloadOccurrences can be run without network access.
+Searches restricted to a range of publication dates ([PDAT]) are answered too,
+with every recorded sequence given a made-up publication date.
+Occurrence downloads are served from zip files in a separate folder, usually
+written by generate_occurrences.py, optionally at a limited bandwidth.
+"""
+
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A publication date range in an ESearch term.
+PDAT_RANGE = re.compile(r'"([\d/]+)"\[PDAT\] : "([\d/]+)"\[PDAT\]')
+
+def publication_date(uid):
+    # Returns the made-up publication date of a sequence, spread over the
+    # years 1990 to 2019.
+    return datetime.date(1990, 1, 1) + datetime.timedelta(days=int(uid) % 10957)
+
+class Fixtures:
+
+    # The recorded responses of a pipeline run, read from its output files.
+
+    def __init__(self, data_dir, downloads_dir):
+        path = lambda name: os.path.join(data_dir, name)
+        with open(path('nuccore-esearch-params.json')) as f:
+            self.esearch = f.read()
+        with open(path('taxonomy-epost-params.xml')) as f:
+            self.epost = f.read()
+        with open(path('nuccore-docsummaries.txt')) as f:
+            self.nuccore = [line.split(',') for line in f.read().splitlines()]
+        with open(path('taxonomy-docsummaries.txt')) as f:
+            self.taxonomy = [line.split(',', maxsplit=1)
+                             for line in f.read().splitlines()]
+        with open(path('gbif-species-matches.txt')) as f:
+            matches = dict(line.split(',') for line in f.read().splitlines())
+        self.species_keys = {sname:int(matches[taxid])
+                             for taxid, sname in self.taxonomy
+                             if taxid in matches}
+        with open(path('download-IDs.txt')) as f:
+            self.download_ids = f.read().splitlines()
+        with open(path('DOIs.txt')) as f:
+            self.dois = dict(zip(self.download_ids, f.read().splitlines()))
+        self.downloads_dir = downloads_dir
+
+
+class StubServer(ThreadingHTTPServer):
+
+    # An HTTP server that answers Entrez requests under '/entrez/eutils/' and
+    # GBIF requests under '/v1/'. Every response is delayed by 'latency'
+    # seconds, GBIF downloads take 'prepare_time' seconds to succeed and each
+    # download is sent at up to 'bandwidth' megabytes per second (0 for no
+    # limit).
+
+    daemon_threads = True
+
+    def __init__(self, address, fixtures, latency=0, prepare_time=0,
+                 bandwidth=0):
+        super().__init__(address, StubRequestHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.prepare_time = prepare_time
+        self.bandwidth = bandwidth
+        self.requested = {} # Download ID -> time of request.
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] += 1
+
+    def next_download_id(self):
+        # Returns the recorded download IDs in turn, then made-up ones.
+        with self.lock:
+            n = len(self.requested)
+            ids = self.fixtures.download_ids
+            if n < len(ids):
+                download_id = ids[n]
+            else:
+                download_id = '{0:07d}-000000000000000'.format(n)
+            self.requested[download_id] = time.monotonic()
+            return download_id
+        
+    def restart_downloads(self):
+        # Prepares the downloads requested so far again from now, as if they
+        # had just been requested.
+        with self.lock:
+            now = time.monotonic()
+            for download_id in self.requested:
+                self.requested[download_id] = now
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+        routes = {('GET', '/entrez/eutils/esearch.fcgi'):self.esearch,
+                  ('POST', '/entrez/eutils/epost.fcgi'):self.epost,
+                  ('GET', '/entrez/eutils/esummary.fcgi'):self.esummary,
+                  ('GET', '/v1/species/match'):self.species_match,
+                  ('POST', '/v1/occurrence/download/request'):
+                      self.download_request}
+        if (method, url.path) in routes:
+            self.server.count(url.path)
+            args = [params] if method == 'GET' else [body]
+            routes[method, url.path](*args)
+        elif url.path.startswith('/v1/occurrence/download/request/'):
+            self.server.count('/v1/occurrence/download/request/<id>.zip')
+            self.download(url.path.rsplit('/', maxsplit=1)[1])
+        elif url.path.startswith('/v1/occurrence/download/'):
+            self.server.count('/v1/occurrence/download/<id>')
+            self.download_status(url.path.rsplit('/', maxsplit=1)[1])
+        else:
+            self.send_error(404)
+
+    def send(self, body, content_type='application/json', status=200):
+        # Sends a response, compressed with gzip if the client accepts it and
+        # the body is large enough to be worth it.
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        compress = (len(body) > 1024
+                    and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        if compress:
+            body = gzip.compress(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def esearch(self, params):
+        # Searches in a range of publication dates get a web environment
+        # naming the range, which 'esummary' pages through.
+        match = PDAT_RANGE.search(params.get('term', ''))
+        if not match:
+            self.send(self.server.fixtures.esearch)
+            return
+        start, end = match.groups()
+        webenv = 'PDAT_{0}_{1}'.format(start, end)
+        count = len(self.nuccore_in(webenv))
+        self.send(json.dumps({'esearchresult':{'count':str(count),
+            'retmax':'0', 'retstart':'0', 'querykey':'1', 'webenv':webenv,
+            'idlist':[]}}))
+
+    def nuccore_in(self, webenv):
+        # Returns the recorded sequences in the range of publication dates
+        # named by a web environment, or all of them.
+        nuccore = self.server.fixtures.nuccore
+        if not webenv.startswith('PDAT_'):
+            return nuccore
+        start, end = [datetime.datetime.strptime(date, '%Y/%m/%d').date()
+                      for date in webenv.split('_')[1:]]
+        return [row for row in nuccore
+                if start <= publication_date(row[0]) <= end]
+
+    def epost(self, body):
+        self.send(self.server.fixtures.epost, 'text/xml')
+
+    def esummary(self, params):
+        fixtures = self.server.fixtures
+        start = int(params.get('retstart', 0))
+        end = start + int(params.get('retmax', 20))
+        result = {'uids':[]}
+        if params['db'] == 'nuccore':
+            nuccore = self.nuccore_in(params.get('webenv', ''))
+            for uid, taxid in nuccore[start:end]:
+                result['uids'].append(uid)
+                result[uid] = {'uid':uid, 'taxid':int(taxid)}
+        else:
+            for taxid, sname in fixtures.taxonomy[start:end]:
+                result['uids'].append(taxid)
+                result[taxid] = {'taxid':int(taxid), 'scientificname':sname}
+        self.send(json.dumps({'result':result}))
+
+    def species_match(self, params):
+        species_key = self.server.fixtures.species_keys.get(params['name'])
+        if species_key:
+            result = {'matchType':'EXACT', 'rank':'SPECIES',
+                      'speciesKey':species_key}
+        else:
+            result = {'matchType':'NONE'}
+        self.send(json.dumps(result))
+
+    def download_request(self, body):
+        self.send(self.server.next_download_id(), 'text/plain', 201)
+
+    def download_status(self, download_id):
+        requested = self.server.requested.get(download_id)
+        if requested is None:
+            self.send_error(404)
+            return
+        elapsed = time.monotonic() - requested
+        status = 'SUCCEEDED' if elapsed >= self.server.prepare_time else 'RUNNING'
+        link = '{0}/v1/occurrence/download/request/{1}.zip'.format(
+            self.server.base_url, download_id)
+        doi = self.server.fixtures.dois.get(download_id, '10.15468/dl.stub')
+        self.send(json.dumps({'key':download_id, 'status':status,
+                              'downloadLink':link, 'doi':doi}))
+
+    def download(self, filename):
+        # Serves a download zip, honouring single-range Range requests.
+        path = os.path.join(self.server.fixtures.downloads_dir, filename)
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            start = int(byte_range[6:].split('-')[0])
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                'bytes {0}-{1}/{2}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        chunk_size = 2**20
+        if self.server.bandwidth:
+            chunk_size = 2**16 # Keeps the rate smooth.
+        with open(path, 'rb') as f:
+            f.seek(start)
+            sent = 0
+            began = time.monotonic()
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.server.bandwidth:
+                    due = began + sent / (self.server.bandwidth * 2**20)
+                    time.sleep(max(0, due - time.monotonic()))
+
+
+def start_server(fixtures, latency=0, prepare_time=0, port=0, bandwidth=0):
+    # Starts a stub server on a background thread and returns it.
+    server = StubServer(('127.0.0.1', port), fixtures, latency, prepare_time,
+                        bandwidth)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--downloads-dir', default='data/downloads')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--prepare-time', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='megabytes per second per download')
+    args = parser.parse_args()
+    fixtures = Fixtures(args.data_dir, args.downloads_dir)
+    server = StubServer(('127.0.0.1', args.port), fixtures, args.latency,
+                        args.prepare_time, args.bandwidth)
+    print('Serving on ' + server.base_url)
+    server.serve_forever()
@@ -8,44 +8,183 @@ Created on Sat May  4 21:48:16 2019
 import requests
 import luigi
 import json
-import xml.etree.ElementTree as ET
 import utils
-import time
-import math
 import csv
+import collections
 import io
+import os
+import shutil
+import datetime
+import functools
+import tarfile
 import zipfile
-import rasterio
-import pandas as pd
 from zipfile import ZipFile
-from contextlib import ExitStack
+from contextlib import ExitStack, closing
+from concurrent.futures import ThreadPoolExecutor
+from luigi.parameter import ParameterVisibility
 from urllib3.util.retry import Retry
 
-class EntrezTask(luigi.Task):
-    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+# Imported on first use, so that tasks start without loading them.
+ET = utils.LazyModule('xml.etree.ElementTree')
+rasterio = utils.LazyModule('rasterio')
+pd = utils.LazyModule('pandas')
+pq = utils.LazyModule('pyarrow.parquet') # Only needed for the columnar format.
+
+class Metrics(luigi.Config):
+    
+    # Each run of an instrumented task writes its metrics to a file named after
+    # the task ID in the 'path' folder, as JSON or, with 'format' set to
+    # 'prometheus', in the Prometheus text format (for example for the node
+    # exporter's textfile collector). Set 'write' to false to turn this off.
+    
+    path = luigi.Parameter(default='data/metrics')
+    format = luigi.ChoiceParameter(choices=['json', 'prometheus'],
+                                   default='json')
+    write = luigi.BoolParameter(default=True,
+                                parsing=luigi.BoolParameter.EXPLICIT_PARSING)
+
+
+class InstrumentedTask(luigi.Task):
+    
+    # Tasks that record metrics of their run. HTTP requests are recorded by
+    # the sessions of WebServiceTask.
+    
+    @property
+    def metrics(self):
+        if not hasattr(self, '_metrics'):
+            self._metrics = utils.TaskMetrics()
+        return self._metrics
+
+
+@InstrumentedTask.event_handler(luigi.Event.START)
+def start_metrics(task):
+    task._metrics = utils.TaskMetrics()
+
+@InstrumentedTask.event_handler(luigi.Event.SUCCESS)
+def write_metrics(task, result='success'):
+    # This function writes the metrics of a finished task as set by Metrics.
+    config = Metrics()
+    if not config.write:
+        return
+    if config.format == 'prometheus':
+        # The task ID tells apart the runs of a family with other parameters,
+        # whose files would otherwise hold the same series.
+        labels = {'task':task.task_family, 'task_id':task.task_id,
+                  'result':result}
+        text = task.metrics.to_prometheus(labels)
+        extension = '.prom'
+    else:
+        summary = dict(task=task.task_id, result=result,
+                       **task.metrics.summary())
+        text = json.dumps(summary, indent=2)
+        extension = '.json'
+    target = luigi.LocalTarget(os.path.join(config.path,
+                                            task.task_id + extension))
+    with target.open('w') as f:
+        f.write(text)
+
+@InstrumentedTask.event_handler(luigi.Event.FAILURE)
+def write_failure_metrics(task, exception):
+    write_metrics(task, 'failure')
+
+
+class WebServiceTask(InstrumentedTask):
+    
+    # Tasks that call a web service at 'url'. Their sessions share one
+    # connection pool per host, with room for 'concurrency' connections, and
+    # one rate limit of 'rate' requests per second per host.
+    
     retries = Retry(backoff_factor=0.1)
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
     timeout = 30
-    retmax = 50 # Entrez limits JSON responses to 500 records per request.
-    api_key = luigi.Parameter(default='<api-key>') # Must register with NCBI.
+    concurrency = 1 # Requests in flight.
+    rate = None
+    
+    def session(self, metrics=None):
+        # Returns a session for requests to 'url', recording them in 'metrics'
+        # (by default those of the task).
+        s = utils.InstrumentedSession(metrics or self.metrics)
+        utils.mount_shared_pool(s, self.url, self.retries, self.concurrency,
+                                self.rate)
+        return s
+
+
+class EntrezTask(WebServiceTask):
+    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+    retmax = 500 # Entrez limits JSON responses to 500 records per request.
+    # Credentials are private so that they stay out of task IDs, which name
+    # the metrics files.
+    api_key = luigi.Parameter(default='<api-key>', # Must register with NCBI.
+                              visibility=ParameterVisibility.PRIVATE)
+    concurrency = luigi.IntParameter(default=3) # ESummary requests in flight.
+
+    @property
+    def rate(self):
+        # NCBI allows 10 requests per second with an API key and 3 without.
+        return 10 if self.api_key not in ('', '<api-key>') else 3
+
+    def get_summaries(self, session, shards, db):
+        # Pages through the ESummary results for a list of (query key, web
+        # environment, count) shards, yielding each document summary in shard
+        # and retstart order.
+        args = [session, self.url + 'esummary.fcgi', shards, self.retmax, db,
+                self.api_key, self.timeout, self.concurrency]
+        pages = sum(-(-count // self.retmax) for _, _, count in shards)
+        for i, (retstart, r) in enumerate(utils.get_esummary_pages(*args)):
+            message = 'Progress: {0:.0%}'.format(i / pages)
+            self.set_status_message(message)
+            print(message)
+            if r.status_code == requests.codes.ok:
+                for key, value in r.json()['result'].items():
+                    # Skips list of UIDs included in result.
+                    if key != 'uids':
+                        yield value
 
     
-class GBIFTask(luigi.Task):
+class GBIFTask(WebServiceTask):
     url = 'http://api.gbif.org/v1/'
-    retries = Retry(backoff_factor=0.1)
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
-    timeout = 30
+
+
+class Store(luigi.Config):
+    
+    # In incremental mode, the UIDs, Taxonomy IDs, species keys and belts of
+    # earlier runs are kept in an SQLite store. Only Taxonomy IDs and species
+    # keys missing from the store are sent through the matching, download and
+    # classification tasks, and ClassifySequences merges the new results with
+    # the stored ones. Outputs of the previous run must be removed as usual.
+    
+    incremental = luigi.BoolParameter(default=False)
+    path = luigi.Parameter(default='data/ginseng.db')
+
+
+class Results(luigi.Config):
+    
+    # ClassifySequences also publishes its results to an SQLite database at
+    # 'path', indexed by UID, species key and belt, along with the number of
+    # sequences and species in each belt. Set 'publish' to false to turn this
+    # off.
+    
+    path = luigi.Parameter(default='data/classified-sequences.db')
+    publish = luigi.BoolParameter(default=True,
+                                  parsing=luigi.BoolParameter.EXPLICIT_PARSING)
 
 
 class SearchNuccore(EntrezTask):
     
     # This task searches the NCBI Nucleotide (Nuccore) database and, using the
     # Entrez History Server and ESearch utility, returns a web environment and
-    # query key.
+    # query key. When the search finds more than 'max_shard_size' records, the
+    # term is also split into disjoint windows of publication dates, halved
+    # until each holds no more than 'max_shard_size' records, and the
+    # esearchresult of each window (with a web environment of its own) is
+    # added to the output under 'shards'. The task fails if the windows do not
+    # add up to the records found, for example because records were added
+    # meanwhile or have no publication date in the searched range.
     
     data = ('chloroplast[Filter] AND plants[Filter] AND complete[Properties] '
             'NOT unverified[Title] AND (120000[SLEN] : 160000[SLEN])')
     term = luigi.Parameter(default=data)
+    max_shard_size = luigi.IntParameter(default=100000)
+    first_date = datetime.date(1970, 1, 1) # Earliest publication date.
     
     def output(self):
         return luigi.LocalTarget('data/nuccore-esearch-params.json')
@@ -53,24 +192,68 @@ class SearchNuccore(EntrezTask):
     def run(self):
         with ExitStack() as stack:
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
+            s = stack.enter_context(self.session())
             
             payload = {'db':'nuccore',
                        'retmode':'json',
                        'usehistory':'y',
                        'term':self.term
                        }
-            s.mount(self.url, self.adapter)
             r = s.get(self.url + 'esearch.fcgi', params=payload,
                 timeout=self.timeout)
-            if r.status_code == requests.codes.ok:
+            if r.status_code != requests.codes.ok:
+                return
+            data = r.json()
+            count = int(data['esearchresult']['count'])
+            if count <= self.max_shard_size:
                 outfile.write(r.text)
+                return
+            data['shards'] = self.search_shards(s, count)
+            json.dump(data, outfile, indent=4)
+            
+    def search_shards(self, s, count):
+        # This function splits the search into windows of publication dates
+        # and returns the esearchresult of each window that found records.
+        pattern = '({0}) AND ("{1:%Y/%m/%d}"[PDAT] : "{2:%Y/%m/%d}"[PDAT])'
+        one_day = datetime.timedelta(days=1)
+        # Tomorrow, as records may be dated in a time zone ahead of ours.
+        windows = [(self.first_date, datetime.date.today() + one_day)]
+        shards = []
+        while windows:
+            start, end = windows.pop()
+            payload = {'db':'nuccore',
+                       'retmode':'json',
+                       'usehistory':'y',
+                       'retmax':0,
+                       'term':pattern.format(self.term, start, end)
+                       }
+            r = s.get(self.url + 'esearch.fcgi', params=payload,
+                timeout=self.timeout)
+            r.raise_for_status()
+            result = r.json()['esearchresult']
+            shard_size = int(result['count'])
+            if shard_size > self.max_shard_size and start < end:
+                middle = start + (end - start) // 2
+                windows += [(middle + one_day, end), (start, middle)]
+            elif shard_size:
+                shards.append(result)
+        found = sum(int(shard['count']) for shard in shards)
+        message = 'Shards: {0}, records: {1} of {2}'.format(len(shards),
+            found, count)
+        self.set_status_message(message)
+        print(message)
+        if found != count:
+            raise Exception('The publication date windows found {0} of {1} '
+                            'records.'.format(found, count))
+        return shards
         
 
 class GetNuccoreSummaries(EntrezTask):
     
     # This task returns a list of UIDs and Taxonomy IDs corresponding to the
-    # previous web environment and query key using the ESummary utility.
+    # previous web environment and query key using the ESummary utility. The
+    # summaries of a sharded search are fetched from all of its shards at
+    # once and deduplicated by UID.
     
     def requires(self):
         return SearchNuccore()
@@ -82,33 +265,24 @@ class GetNuccoreSummaries(EntrezTask):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
-            
-            s.mount(self.url, self.adapter)            
-            result = json.load(infile)['esearchresult']
-            query_key = result['querykey']
-            webenv = result['webenv']
-            count = int(result['count'])        
-            for retstart in range(0, count, self.retmax):
-                time.sleep(0.1) # 10 requests per second limit.
-                message = 'Progress: {0:.0%}'.format(retstart / count)
-                self.set_status_message(message)
-                print(message)
-                args = [query_key, webenv, retstart,
-                        self.retmax, 'nuccore', self.api_key]
-                prepped = utils.prep_esummary_req(*args)
-                r = s.send(prepped, timeout=self.timeout, stream=False)
-                if r.status_code == requests.codes.ok:
-                    for key, value in r.json()['result'].items():
-                        # Skips list of UIDs included in result.
-                        if key != 'uids':
-                            data = {'uid':value['uid'],
-                                    'taxid':value['taxid']
-                                    }
-                            outfile.write('{uid},{taxid}\n'.format(**data))
+            s = stack.enter_context(self.session())
+            
+            data = json.load(infile)
+            results = data.get('shards', [data['esearchresult']])
+            shards = [(result['querykey'], result['webenv'],
+                       int(result['count'])) for result in results]
+            uids = set() # Shards are disjoint but are deduplicated anyway.
+            for value in self.get_summaries(s, shards, 'nuccore'):
+                if value['uid'] in uids:
+                    continue
+                uids.add(value['uid'])
+                data = {'uid':value['uid'],
+                        'taxid':value['taxid']
+                        }
+                outfile.write('{uid},{taxid}\n'.format(**data))
                                 
 
-class RemoveDuplicateTaxIDs(luigi.Task):
+class RemoveDuplicateTaxIDs(InstrumentedTask):
     
     # This task returns a list of unique Taxonomy IDs.
     
@@ -124,6 +298,9 @@ class RemoveDuplicateTaxIDs(luigi.Task):
             outfile = stack.enter_context(self.output().open('w'))        
             lines = [line.split(',') for line in infile.read().splitlines()]
             taxids = set([taxid for uid,taxid in lines])
+            if Store().incremental:
+                with utils.SequenceStore(Store().path) as store:
+                    taxids -= store.get_taxids()
             for taxid in taxids:
                 outfile.write(taxid + '\n')
                 
@@ -144,101 +321,311 @@ class PostTaxIDs(EntrezTask):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())        
+            s = stack.enter_context(self.session())        
         
             taxids = ','.join(infile.read().splitlines())
+            if not taxids:
+                return # Nothing new to post in incremental mode.
             payload = {'db':'taxonomy', 'id':taxids}
-            s.mount(self.url, self.adapter)        
             r = s.post(self.url + 'epost.fcgi', data=payload,
                 timeout=self.timeout)
             if r.status_code == requests.codes.ok:
                 outfile.write(r.text)
                     
             
+class BuildTaxdumpIndex(InstrumentedTask):
+    
+    # This task builds an SQLite index of the scientific names and the merged
+    # and deleted Taxonomy IDs in an NCBI taxdump archive (taxdump.tar.gz, or
+    # a folder it was extracted to), so that GetTaxonomySummaries can look up
+    # names offline.
+    
+    taxdump_path = luigi.Parameter(default='data/taxdump.tar.gz')
+    
+    def output(self):
+        return luigi.LocalTarget('data/taxdump-index.db',
+            format=luigi.format.Nop)
+    
+    def run(self):
+        with ExitStack() as stack:
+            if os.path.isdir(self.taxdump_path):
+                members = [(name, stack.enter_context(open(os.path.join(
+                    self.taxdump_path, name), 'rb')))
+                    for name in utils.TAXDUMP_FILES]
+            else:
+                archive = stack.enter_context(tarfile.open(self.taxdump_path))
+                members = ((member.name, archive.extractfile(member))
+                           for member in archive
+                           if member.name in utils.TAXDUMP_FILES)
+            path = stack.enter_context(self.output().temporary_path())
+            index = stack.enter_context(utils.TaxdumpIndex(path))
+            self.set_status_message('Indexing ' + self.taxdump_path)
+            self.metrics.add_rows(index.build(members))
+            
+            
 class GetTaxonomySummaries(EntrezTask):
     
     # This task returns a list of Taxonomy IDs and scientific names
     # corresponding to the previous web environment and query key using the
-    # ESummary utility. 
+    # ESummary utility. With 'source' set to 'taxdump', the names are looked
+    # up in the index built by BuildTaxdumpIndex instead, without posting the
+    # Taxonomy IDs. Merged Taxonomy IDs are then listed with the name of the
+    # taxon they were merged into and deleted ones are left out.
+    
+    source = luigi.ChoiceParameter(choices=['entrez', 'taxdump'],
+                                   default='entrez')
     
     def requires(self):
+        if self.source == 'taxdump':
+            return BuildTaxdumpIndex(), RemoveDuplicateTaxIDs()
         return PostTaxIDs(), RemoveDuplicateTaxIDs()
         
     def output(self):
         return luigi.LocalTarget('data/taxonomy-docsummaries.txt')
         
     def run(self):
+        if self.source == 'taxdump':
+            self.run_taxdump()
+            return
+        
         with ExitStack() as stack:
             infiles = [stack.enter_context(f.open('r')) for f in self.input()]
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
+            s = stack.enter_context(self.session())
             
-            s.mount(self.url, self.adapter)
+            count = len(infiles[1].read().splitlines())
+            if not count:
+                return # Nothing new was posted in incremental mode.
             tree = ET.parse(infiles[0])
             root = tree.getroot()
             query_key = root[0].text
             webenv = root[1].text
-            count = len(infiles[1].read().splitlines())
-            for retstart in range(0, count, self.retmax):
-                time.sleep(0.1) # 10 requests per second limit.
-                message = 'Progress: {0:.0%}'.format(retstart / count)
-                self.set_status_message(message)
-                print(message)
-                args = [query_key, webenv, retstart,
-                    self.retmax, 'taxonomy', self.api_key]
-                prepped = utils.prep_esummary_req(*args)
-                r = s.send(prepped, timeout=self.timeout, stream=False)
-                if r.status_code == requests.codes.ok:
-                    for key, value in r.json()['result'].items():
-                        # Skips list of UIDs included in result.
-                        if key != 'uids':
-                            data = {'taxid':value['taxid'],
-                                    'sname':value['scientificname']
-                                    }                        
-                            outfile.write('{taxid},{sname}\n'.format(**data))
+            for value in self.get_summaries(s, [(query_key, webenv, count)],
+                                            'taxonomy'):
+                data = {'taxid':value['taxid'],
+                        'sname':value['scientificname']
+                        }                        
+                outfile.write('{taxid},{sname}\n'.format(**data))
+                
+    def run_taxdump(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input()[1].open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            index = stack.enter_context(utils.TaxdumpIndex(
+                self.input()[0].path))
+            
+            taxids = infile.read().splitlines()
+            names, merged, deleted = index.resolve(taxids)
+            for taxid, sname in names:
+                data = {'taxid':taxid,
+                        'sname':sname
+                        }
+                outfile.write('{taxid},{sname}\n'.format(**data))
+            message = ('Names: {0}, merged: {1}, deleted: {2}, unknown: {3}'
+                       .format(len(names), merged, deleted,
+                               len(taxids) - len(names) - deleted))
+            self.set_status_message(message)
+            print(message)
                                     
 
-class GBIFSpeciesMatch(GBIFTask):
+class BuildBackboneIndex(InstrumentedTask):
+    
+    # This task builds an SQLite index of the plant names in a GBIF Backbone
+    # Taxonomy dump (backbone.zip, or the Taxon.tsv file extracted from it),
+    # so that GBIFSpeciesMatch can match names offline.
+    
+    backbone_path = luigi.Parameter(default='data/backbone.zip')
+    kingdom = 'Plantae'
+    
+    def output(self):
+        return luigi.LocalTarget('data/gbif-backbone-index.db',
+            format=luigi.format.Nop)
+    
+    def run(self):
+        with ExitStack() as stack:
+            if zipfile.is_zipfile(self.backbone_path):
+                archive = stack.enter_context(ZipFile(self.backbone_path))
+                taxon_file = stack.enter_context(archive.open('Taxon.tsv'))
+            else:
+                taxon_file = stack.enter_context(open(self.backbone_path, 'rb'))
+            path = stack.enter_context(self.output().temporary_path())
+            index = stack.enter_context(utils.BackboneIndex(path))
+            self.set_status_message('Indexing ' + self.backbone_path)
+            rows = index.build(taxon_file, self.kingdom, GBIFSpeciesMatch.ranks)
+            self.metrics.add_rows(rows)
+            
+            
+class SpeciesMatcher:
+    
+    # This class holds the name matching shared by GBIFSpeciesMatch and
+    # CompareSpeciesMatches. Tasks using it define 'concurrency' and
+    # 'fuzzy_cutoff', and require BuildBackboneIndex as their second input
+    # when matching against the backbone.
+    
+    ranks = ['SPECIES', 'SUBSPECIES', 'VARIETY', 'SUBVARIETY', 'FORM',
+             'SUBFORM', 'CULTIVAR_GROUP', 'CULTIVAR']
+    
+    def match_api(self, stack, names, cache=None):
+        # This function matches names with the Species API and returns their
+        # species keys, or None where there is no match at one of 'ranks'.
+        # Results are read from and added to 'cache' when one is given.
+        s = stack.enter_context(self.session())
+        executor = stack.enter_context(
+            ThreadPoolExecutor(self.concurrency))
+        
+        payloads = [{'name': sname, 'kingdom':'plantae', 'strict':'true'}
+                    for sname in names]
+        results = [None] * len(payloads)
+        if cache is not None:
+            results = [cache.get(payload) for payload in payloads]
+        misses = [i for i, result in enumerate(results) if result is None]
+        hits = len(results) - len(misses)
+        
+        def match(i):
+            r = s.get(self.url + 'species/match', params=payloads[i],
+                      stream=False, timeout=self.timeout)
+            return i, r
+        
+        responses = utils.map_bounded(executor, match, misses,
+                                      2 * self.concurrency)
+        for j, (i, r) in enumerate(responses):
+            message = ('Progress: {0:.0%} (cache hits: {1}, misses: {2})'
+                       .format(j / len(misses), hits, len(misses)))
+            self.set_status_message(message)
+            if j % 10 == 0: print(message)
+            if r.status_code == requests.codes.ok:
+                results[i] = r.json()
+                if cache is not None:
+                    cache.put(payloads[i], results[i])
+        
+        message = 'Cache hits: {0}, misses: {1}'.format(hits, len(misses))
+        self.set_status_message(message)
+        print(message)
+        species_keys = []
+        for result in results:
+            if (result is not None and result['matchType'] != 'NONE'
+                    and result['rank'] in self.ranks):
+                species_keys.append(result['speciesKey'])
+            else:
+                species_keys.append(None)
+        return species_keys
+    
+    def match_backbone(self, stack, names):
+        # This function matches names against the backbone index and returns
+        # their species keys and match types.
+        index = stack.enter_context(utils.BackboneIndex(self.input()[1].path))
+        matches = []
+        for i, sname in enumerate(names):
+            if i % 1000 == 0:
+                message = 'Progress: {0:.0%}'.format(i / len(names))
+                self.set_status_message(message)
+                print(message)
+            matches.append(index.match(sname, self.fuzzy_cutoff))
+        counts = collections.Counter(match_type for skey, match_type in matches)
+        message = 'Exact: {0}, fuzzy: {1}, none: {2}'.format(counts['EXACT'],
+            counts['FUZZY'], counts['NONE'])
+        self.set_status_message(message)
+        print(message)
+        return matches
+    
+    
+class GBIFSpeciesMatch(SpeciesMatcher, GBIFTask):
 
     # This task uses the GBIF Species API to map the previous list of scientific
     # names from the NCBI Taxonomy Database to a list of GBIF species keys.
+    # Match results are kept in an on-disk cache for 'cache_ttl' days so that
+    # only names missing from the cache are sent to the API. With 'matcher'
+    # set to 'backbone', the names are matched offline against the index
+    # built by BuildBackboneIndex instead, falling back to the most similar
+    # name of the same genus down to a similarity of 'fuzzy_cutoff'.
+    
+    cache_path = luigi.Parameter(default='data/gbif-species-match-cache.db')
+    cache_ttl = luigi.FloatParameter(default=90) # Days.
+    concurrency = luigi.IntParameter(default=4) # Match requests in flight.
+    matcher = luigi.ChoiceParameter(choices=['api', 'backbone'], default='api')
+    fuzzy_cutoff = luigi.FloatParameter(default=0.9)
     
     def requires(self):
-        return GetTaxonomySummaries()
+        tasks = [GetTaxonomySummaries()]
+        if self.matcher == 'backbone':
+            tasks.append(BuildBackboneIndex())
+        return tasks
         
     def output(self):
         return luigi.LocalTarget('data/gbif-species-matches.txt')
         
     def run(self):
         with ExitStack() as stack:
-            infile = stack.enter_context(self.input().open('r'))
+            infile = stack.enter_context(self.input()[0].open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
-            s.mount(self.url, self.adapter)
     
             entrez_data = [ln.split(',', maxsplit=1) for ln 
                            in infile.read().splitlines()]
-        
-            ranks = ['SPECIES', 'SUBSPECIES', 'VARIETY', 'SUBVARIETY', 'FORM',
-                    'SUBFORM', 'CULTIVAR_GROUP', 'CULTIVAR']
-                
-            for i, line in enumerate(entrez_data):
-                taxid, sname = line
-                message = 'Progress: {0:.0%}'.format(i / len(entrez_data))
-                self.set_status_message(message)
-                if i % 10 == 0: print(message)
-                payload = {'name': sname, 'kingdom':'plantae', 'strict':'true'}
-                r = s.get(self.url + 'species/match', params=payload,
-                          stream=False, timeout=self.timeout)
-                if r.status_code == requests.codes.ok:
-                    result = r.json()
-                    if result['matchType'] != 'NONE' and result['rank'] in ranks:
-                        data = {'taxid':taxid,
-                                'skey':result['speciesKey']}
-                        outfile.write('{taxid},{skey}\n'.format(**data))
-                                    
+            names = [sname for taxid, sname in entrez_data]
+            
+            if self.matcher == 'backbone':
+                matches = self.match_backbone(stack, names)
+                species_keys = [skey for skey, match_type in matches]
+            else:
+                cache = stack.enter_context(utils.SpeciesMatchCache(
+                    self.cache_path, self.cache_ttl * 86400))
+                species_keys = self.match_api(stack, names, cache)
+            for (taxid, sname), skey in zip(entrez_data, species_keys):
+                if skey is not None:
+                    data = {'taxid':taxid,
+                            'skey':skey}
+                    outfile.write('{taxid},{skey}\n'.format(**data))
+    
+    
+class CompareSpeciesMatches(SpeciesMatcher, GBIFTask):
+    
+    # This task matches a sample of up to 'sample_size' names, evenly spread
+    # over the list of scientific names, both with the Species API and against
+    # the backbone index, and reports the names on which they disagree. A
+    # 'sample_size' of 0 compares every name. The API is always queried live,
+    # bypassing the cache of GBIFSpeciesMatch.
+    
+    sample_size = luigi.IntParameter(default=1000)
+    concurrency = luigi.IntParameter(default=4) # Match requests in flight.
+    fuzzy_cutoff = luigi.FloatParameter(default=0.9)
+    
+    def requires(self):
+        return [GetTaxonomySummaries(), BuildBackboneIndex()]
+    
+    def output(self):
+        return luigi.LocalTarget('data/gbif-match-disagreements.txt')
+    
+    def run(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input()[0].open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            
+            entrez_data = [ln.split(',', maxsplit=1) for ln
+                           in infile.read().splitlines()]
+            sample = entrez_data
+            if self.sample_size:
+                step = max(1, len(entrez_data) // self.sample_size)
+                sample = entrez_data[::step][:self.sample_size]
+            names = [sname for taxid, sname in sample]
+            api_keys = self.match_api(stack, names)
+            matches = self.match_backbone(stack, names)
+            
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(['Taxonomy ID', 'Name', 'API Species Key',
+                             'Backbone Species Key', 'Backbone Match'])
+            disagreements = 0
+            for (taxid, sname), api_key, (skey, match_type) in zip(sample,
+                    api_keys, matches):
+                if api_key != skey:
+                    writer.writerow([taxid, sname, api_key, skey, match_type])
+                    disagreements += 1
+            message = 'Disagreements: {0} of {1} names'.format(disagreements,
+                len(sample))
+            self.set_status_message(message)
+            print(message)
                         
-class RemoveDuplicateSpeciesKeys(luigi.Task):
+                        
+class RemoveDuplicateSpeciesKeys(InstrumentedTask):
 
     # This task returns a list of unique species keys.
 
@@ -254,6 +641,9 @@ class RemoveDuplicateSpeciesKeys(luigi.Task):
             outfile = stack.enter_context(self.output().open('w'))
             lines = [line.split(',') for line in infile.read().splitlines()]
             species_keys = set([skey for taxid,skey in lines])
+            if Store().incremental:
+                with utils.SequenceStore(Store().path) as store:
+                    species_keys -= store.get_species_keys()
             for species_key in species_keys:
                 outfile.write(species_key + '\n')
                 
@@ -261,15 +651,25 @@ class RemoveDuplicateSpeciesKeys(luigi.Task):
 class PostUsageKeys(GBIFTask):
 
     # This task posts the previous list of unique species keys to the GBIF
-    # Occurrence Store in chunk sizes of no larger than 300 and returns a list
-    # of download IDs.
+    # Occurrence Store and returns a list of download IDs. The keys are split
+    # over as many requests as may run at once under GBIF's quota of
+    # 'max_running_downloads' per user, in chunks of up to 'max_chunk_size'
+    # keys, and more are submitted as earlier downloads finish. Each submitted
+    # chunk is recorded in a journal so that a restarted run does not post its
+    # keys again.
 
-    user = luigi.Parameter(default='<user>') # Must create account with GBIF.
-    pwd = luigi.Parameter(default='<pwd>') # Must create account with GBIF.
-    chunk_size = 300
-    retries = Retry(backoff_factor=4, status_forcelist=[503, 420], total=None,
-        connect=10, read=10, redirect=10, status=250, method_whitelist=['POST'])
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+    user = luigi.Parameter(default='<user>', # Must create account with GBIF.
+                           visibility=ParameterVisibility.PRIVATE)
+    pwd = luigi.Parameter(default='<pwd>', # Must create account with GBIF.
+                          visibility=ParameterVisibility.PRIVATE)
+    max_chunk_size = luigi.IntParameter(default=10000)
+    max_running_downloads = luigi.IntParameter(default=3)
+    journal_path = luigi.Parameter(default='data/download-requests.jsonl')
+    poll_interval = 10
+    max_poll_interval = 300
+    retries = Retry(backoff_factor=4, status_forcelist=[503], total=None,
+        connect=10, read=10, redirect=10, status=10,
+        method_whitelist=['GET', 'POST'])
 
     def requires(self):
         return RemoveDuplicateSpeciesKeys()
@@ -277,39 +677,50 @@ class PostUsageKeys(GBIFTask):
     def output(self):
         return luigi.LocalTarget('data/download-IDs.txt')
     
+    def read_journal(self, species_keys):
+        # Returns the (download ID, species keys) pairs recorded by an earlier
+        # attempt, skipping any with species keys that are no longer posted.
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        species_keys = set(species_keys)
+        return [(entry['download_id'], entry['species_keys'])
+                for entry in entries
+                if species_keys.issuperset(entry['species_keys'])]
+    
     def run(self):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())    
+            s = stack.enter_context(self.session())    
     
             species_keys = infile.read().splitlines()
-            length = len(species_keys)
-        
-            number_of_chunks = math.ceil(length / self.chunk_size)
+            submitted = self.read_journal(species_keys)
+            posted = set(key for _, keys in submitted for key in keys)
+            remaining = [key for key in species_keys if key not in posted]
+            journal = stack.enter_context(open(self.journal_path, 'a'))
         
-            s.mount(self.url, self.adapter)
             s.auth = (self.user, self.pwd)
             
-            for i, start in enumerate(range(0, length, self.chunk_size)):
-                message = 'Progress: {0:.0%}'.format(i / number_of_chunks)
+            args = [s, self.url, remaining, self.timeout, self.max_chunk_size,
+                    self.max_running_downloads, self.poll_interval,
+                    self.max_poll_interval,
+                    [download_id for download_id, _ in submitted]]
+            for chunk, download_id in utils.submit_download_requests(*args):
+                entry = {'download_id':download_id, 'species_keys':chunk}
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+                submitted.append((download_id, chunk))
+                posted.update(chunk)
+                message = 'Progress: {0:.0%}'.format(
+                    len(posted) / len(species_keys))
                 self.set_status_message(message)
                 print(message)
                 
-                end = start + self.chunk_size
-            
-                if end < length:
-                    chunk = species_keys[start:end]
-                else:
-                    chunk = species_keys[start:]
-                
-                payload = utils.generate_query_expression(chunk)
-                r = s.post(self.url + 'occurrence/download/request',
-                            json=payload, timeout=self.timeout)
-                print(r.status_code)
-                if r.status_code == 201:
-                    download_id = r.text
-                    outfile.write(download_id + '\n')
+            for download_id, _ in submitted:
+                outfile.write(download_id + '\n')
+        os.remove(self.journal_path)
                         
                 
 class GetDOIs(GBIFTask):
@@ -327,10 +738,9 @@ class GetDOIs(GBIFTask):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
+            s = stack.enter_context(self.session())
             
             download_ids = infile.read().splitlines()
-            s.mount(self.url, self.adapter)
             
             for download_id in download_ids:
                 r = s.get(self.url + 'occurrence/download/' + download_id)
@@ -342,7 +752,16 @@ class GetDOIs(GBIFTask):
 class GetDownloadLinks(GBIFTask):
     
     # This task checks the status of the previously submitted download requests
-    # and returns a list of download links.    
+    # and returns a list of download links. All requests are polled at once,
+    # each backing off from 'poll_interval' to 'max_poll_interval' seconds, and
+    # the links are listed in the order the downloads succeed. The output is
+    # only complete once every download has succeeded; ClassifyOccurrences
+    # polls the requests itself in streamed mode to start on each archive as
+    # soon as it is ready.
+    
+    poll_interval = 10
+    max_poll_interval = 300
+    max_polls = 250 # Per download request.
     
     def requires(self):
         return PostUsageKeys()
@@ -354,31 +773,39 @@ class GetDownloadLinks(GBIFTask):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
+            s = stack.enter_context(self.session())
     
             download_ids = infile.read().splitlines()
-            s.mount(self.url, self.adapter)
-            for i, download_id in enumerate(download_ids):
-                message = 'Progress: {0:.0%}'.format(i / len(download_ids))
+            for i, (download_id, download_link) in enumerate(
+                    self.poll(s, download_ids)):
+                message = 'Progress: {0:.0%}'.format(
+                    (i + 1) / len(download_ids))
                 self.set_status_message(message)
                 print(message)
-                url = self.url + 'occurrence/download/' + download_id
-                for j in range(250):
-                    download_link = utils.get_download_link(s, url, self.timeout)
-                    if download_link:
-                        outfile.write(download_link + '\n')
-                        break
-                    else:
-                        time.sleep(30)
-                        continue
-                else:
-                    raise Exception('Unable to get download link.')
+                outfile.write(download_link + '\n')
+                
+    def poll(self, session, download_ids):
+        # Yields (download ID, download link) pairs as the downloads succeed.
+        urls = [self.url + 'occurrence/download/' + download_id
+                for download_id in download_ids]
+        args = [session, urls, self.timeout, self.poll_interval,
+                self.max_poll_interval, self.max_polls]
+        for i, download_link in utils.poll_download_links(*args):
+            yield download_ids[i], download_link
                             
             
 class DownloadOccurrences(GBIFTask):
 
     # This task downloads and consolidates the zipped occurrence datasets using
-    # the previous list of download links.
+    # the previous list of download links. Up to 'concurrency' links are
+    # downloaded at once into 'download_dir', where interrupted transfers are
+    # resumed on the next run. The compressed data of each verified download is
+    # copied to the consolidated archive as is.
+    
+    chunk_size = 2**20 # Bytes read from the network at a time.
+    attempts = 5 # Resumptions of a failed transfer before giving up.
+    download_dir = luigi.Parameter(default='data/downloads')
+    concurrency = luigi.IntParameter(default=4) # Downloads in flight.
     
     def requires(self):
         return GetDownloadLinks()
@@ -390,47 +817,222 @@ class DownloadOccurrences(GBIFTask):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            s = stack.enter_context(requests.Session())
-            s.mount(self.url, self.adapter)
+            s = stack.enter_context(self.session())
+            executor = stack.enter_context(
+                ThreadPoolExecutor(self.concurrency))
             
             download_links = infile.read().splitlines()
+            os.makedirs(self.download_dir, exist_ok=True)
             
+            download = functools.partial(self.download, s)
+            paths = utils.map_bounded(executor, download, download_links,
+                                      self.concurrency)
             with ZipFile(outfile, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
-                for i, download_link in enumerate(download_links):
+                for i, path in enumerate(paths):
                     message = 'Progress: {0:.0%}'.format(i / len(download_links))
                     self.set_status_message(message)
                     print(message)
+                    with open(path, 'rb') as stream:
+                        utils.copy_stream(stream, archive)
                     
-                    with s.get(download_link, stream=True, timeout=120) as r:
-                        if r.status_code == requests.codes.ok:
-                            stream = io.BytesIO(r.content)
-                            utils.copy_stream(stream, archive)
+            for download_link in download_links:
+                filename = download_link.rsplit('/', maxsplit=1)[-1]
+                os.remove(os.path.join(self.download_dir, filename))
+                
+    def download(self, session, download_link):
+        # Downloads a link into 'download_dir' and returns the path to the
+        # verified archive.
+        filename = download_link.rsplit('/', maxsplit=1)[-1]
+        path = os.path.join(self.download_dir, filename)
+        args = [session, download_link, path, 120, self.chunk_size,
+                self.attempts]
+        utils.download_file(*args)
+        if not zipfile.is_zipfile(path):
+            os.remove(path)
+            raise Exception('Corrupt download: ' + download_link)
+        return path
                                 
                 
-class ClassifyOccurrences(luigi.Task):
+class OccurrenceTask(InstrumentedTask):
+    
+    # Tasks that read the consolidated occurrence archive in blocks of whole
+    # lines of roughly 'block_size' bytes.
+    
+    block_size = luigi.IntParameter(default=2**24)
+    
+    def read_blocks(self, archive, files):
+        # Yields blocks of occurrence records from each file in the archive.
+        for i, file in enumerate(files):
+            message = 'Progress: {0:.0%}'.format(i / len(files))
+            self.set_status_message(message)
+            print(message)
+            yield from self.read_file_blocks(archive, file)
+            
+    def read_file_blocks(self, archive, file):
+        # Yields blocks of occurrence records from one file in the archive.
+        with archive.open(file) as binary:
+            blocks = utils.read_occurrence_blocks(binary, self.block_size)
+            for block in blocks:
+                self.metrics.add_rows(block.count(b'\n'))
+                yield block
+                
+                
+class ConvertOccurrences(OccurrenceTask):
+    
+    # This task converts the occurrence datasets to a compressed Parquet file
+    # holding only the typed columns needed for classification, so that they
+    # can be classified again without re-parsing the archive.
+    
+    def requires(self):
+        return DownloadOccurrences()
+    
+    def output(self):
+        return luigi.LocalTarget('data/occurrences.parquet',
+            format=luigi.format.Nop)
+    
+    def run(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input().open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            archive = stack.enter_context(ZipFile(infile, 'r'))
+            writer = stack.enter_context(pq.ParquetWriter(outfile,
+                utils.get_schema('occurrences'), compression='zstd'))
+            
+            for block in self.read_blocks(archive, archive.infolist()):
+                writer.write_table(utils.convert_occurrence_block(block))
+                
+                
+class BuildBeltTables(InstrumentedTask):
+    
+    # This task precomputes the summed-area table of each belt of the raster
+    # and caches them on disk next to it, so that ClassifyOccurrences can count
+    # the belts within any radius with a constant number of lookups. The
+    # raster is read a strip of blocks at a time, so it is never loaded whole.
+    
+    path_to_raster_data = luigi.Parameter(default='data/k2classes.tif')
+    
+    def output(self):
+        name = os.path.splitext(self.path_to_raster_data)[0]
+        return luigi.LocalTarget(name + '-belt-tables.npy',
+            format=luigi.format.Nop)
+    
+    def run(self):
+        with ExitStack() as stack:
+            # Each block is read once, so none needs to be cached.
+            band = stack.enter_context(
+                utils.WindowedBand(self.path_to_raster_data, 0))
+            path = stack.enter_context(self.output().temporary_path())
+            height, width = band.shape
+            strips = utils.build_belt_tables(band, path)
+            for i, rows in enumerate(strips):
+                message = 'Progress: {0:.0%}'.format(rows / height)
+                self.set_status_message(message)
+                if i % 10 == 0: print(message)
+            self.metrics.add_rows(height * width)
+            
+            
+class ClassifyOccurrences(OccurrenceTask):
 
     # This task iterates through the occurrence datasets and returns a
-    # consolidated list of classified species keys.
+    # consolidated list of classified species keys. In batch mode, records are
+    # read and classified in blocks of 'block_size' bytes using NumPy. Setting
+    # 'processes' above one classifies the blocks in a pool of processes. In
+    # columnar mode, the occurrences are read from the Parquet file written by
+    # ConvertOccurrences and the classifications are written as Parquet too.
+    # In windowed mode, the raster is memory-mapped or read a block at a time
+    # through a cache of 'raster_cache_size' bytes (per process) instead of
+    # being loaded whole. With 'dedupe', the occurrences of each block are
+    # collapsed to unique (species key, raster row, column) cells, which are
+    # classified once and written with their counts, in batch mode. In radius
+    # mode, records with a coordinate uncertainty of up to 'max_radius' meters
+    # are kept and the pixels of each belt within that radius are counted in
+    # the tables built by BuildBeltTables, so that each record is written with
+    # its belt distribution instead of a single belt. In streamed mode, the
+    # download requests are polled as GetDownloadLinks polls them, each archive
+    # is downloaded as DownloadOccurrences downloads them (with their settings)
+    # as soon as it is ready, and each one is classified as soon as it is
+    # complete, taken from a queue holding at most 'queue_size' archives, so
+    # that occurrences.zip is never written. The classifications of each
+    # archive are committed to a part file, which marks the archive as done if
+    # the task is restarted, and the parts are joined in the order of the
+    # download IDs at the end. Records are classified in batch mode and
+    # 'columnar' does not apply. The belt tables are always memory-mapped, so
+    # 'windowed' has no effect in radius mode.
 
     coord_uncertainty_limit = luigi.IntParameter(default=4500)
     path_to_raster_data = luigi.Parameter(default='data/k2classes.tif')
+    batch = luigi.BoolParameter(default=False)
+    columnar = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=1)
+    windowed = luigi.BoolParameter(default=False)
+    raster_cache_size = luigi.IntParameter(default=2**28)
+    dedupe = luigi.BoolParameter(default=False)
+    radius = luigi.BoolParameter(default=False)
+    max_radius = luigi.IntParameter(default=100000) # Meters.
+    streamed = luigi.BoolParameter(default=False)
+    queue_size = luigi.IntParameter(default=2) # Archives awaiting classification.
+    rows_per_batch = 2**20 # Rows read from the Parquet file at a time.
 
     def requires(self):
-        return DownloadOccurrences()
+        if self.streamed:
+            occurrences = PostUsageKeys()
+        elif self.columnar:
+            occurrences = ConvertOccurrences()
+        else:
+            occurrences = DownloadOccurrences()
+        if self.radius:
+            return occurrences, BuildBeltTables(self.path_to_raster_data)
+        return occurrences
+    
+    def input_occurrences(self):
+        # Returns the occurrences target (the download IDs in streamed mode),
+        # which comes first in radius mode.
+        return self.input()[0] if self.radius else self.input()
+    
+    @property
+    def limit(self):
+        # The highest coordinate uncertainty classified.
+        if self.radius:
+            return self.max_radius
+        return self.coord_uncertainty_limit
     
     def output(self):
-        return luigi.LocalTarget('data/classifications.txt')
+        if self.radius:
+            name = 'data/belt-distributions'
+        elif self.dedupe:
+            name = 'data/classified-cells'
+        else:
+            name = 'data/classifications'
+        if self.columnar and not self.streamed:
+            return luigi.LocalTarget(name + '.parquet', format=luigi.format.Nop)
+        return luigi.LocalTarget(name + '.txt')
     
     def run(self):
+        if self.streamed:
+            self.run_streamed()
+            return
+        if self.columnar:
+            self.run_columnar()
+            return
+        
         with ExitStack() as outer_stack:
-            infile = outer_stack.enter_context(self.input().open('r'))
+            infile = outer_stack.enter_context(
+                self.input_occurrences().open('r'))
             outfile = outer_stack.enter_context(self.output().open('w'))
             archive = outer_stack.enter_context(ZipFile(infile, 'r'))
             raster_data = outer_stack.enter_context(
                 rasterio.open(self.path_to_raster_data))
             
             files = archive.infolist()
-            band = raster_data.read(1)
+            band = self.read_band(outer_stack, raster_data)
+            
+            if self.batch or self.processes > 1 or self.dedupe or self.radius:
+                blocks = self.read_blocks(archive, files)
+                args = [raster_data.transform, band, self.limit]
+                results = self.classify(utils.classify_block, blocks, args)
+                for result in results:
+                    outfile.write(result)
+                return
             
             for i, file in enumerate(files):
                 message = 'Progress: {0:.0%}'.format(i / len(files))
@@ -455,12 +1057,193 @@ class ClassifyOccurrences(luigi.Task):
                         if belt:
                             data = {'skey':species_key, 'belt':belt} 
                             outfile.write('{skey},{belt}\n'.format(**data))
+                    self.metrics.add_rows(reader.line_num - 1)
+
+    def run_streamed(self):
+        poller = GetDownloadLinks()
+        downloader = DownloadOccurrences()
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input_occurrences().open('r'))
+            raster_data = stack.enter_context(
+                rasterio.open(self.path_to_raster_data))
+            s = stack.enter_context(downloader.session(self.metrics))
+            
+            download_ids = infile.read().splitlines()
+            parts = {download_id:self.part(download_id)
+                     for download_id in download_ids}
+            pending = [download_id for download_id in download_ids
+                       if not parts[download_id].exists()]
+            for download_id in download_ids:
+                if download_id not in pending:
+                    # Left behind if the last run stopped right after
+                    # committing the part.
+                    self.remove_archive(downloader, download_id)
+            band = self.read_band(stack, raster_data)
+            args = [raster_data.transform, band, self.limit]
+            pool = None
+            if self.processes > 1:
+                pool = stack.enter_context(
+                    utils.classification_pool(*args, self.processes))
+            executor = stack.enter_context(
+                ThreadPoolExecutor(downloader.concurrency))
+            os.makedirs(downloader.download_dir, exist_ok=True)
+            
+            def download(ready):
+                return downloader.download(s, ready[1])
+            
+            ready = poller.poll(s, pending)
+            archives = stack.enter_context(closing(utils.map_as_completed(
+                executor, download, ready, self.queue_size)))
+            done = len(download_ids) - len(pending)
+            for i, ((download_id, _), path) in enumerate(archives, done):
+                message = 'Progress: {0:.0%}'.format(i / len(download_ids))
+                self.set_status_message(message)
+                print(message)
+                with ExitStack() as inner_stack:
+                    archive = inner_stack.enter_context(ZipFile(path, 'r'))
+                    outfile = inner_stack.enter_context(
+                        parts[download_id].open('w'))
+                    blocks = (block for file in archive.infolist()
+                              for block in self.read_file_blocks(archive, file))
+                    results = self.classify(utils.classify_block, blocks, args,
+                                            pool)
+                    for result in results:
+                        outfile.write(result)
+                os.remove(path)
+        
+        with self.output().open('w') as outfile:
+            for download_id in download_ids:
+                with parts[download_id].open('r') as part:
+                    shutil.copyfileobj(part, outfile)
+        # There is no folder if there was nothing to download.
+        shutil.rmtree(self.parts_dir(), ignore_errors=True)
         
+    def remove_archive(self, downloader, download_id):
+        # Removes the downloaded archive of a download, if it is still there.
+        path = os.path.join(downloader.download_dir, download_id + '.zip')
+        if os.path.exists(path):
+            os.remove(path)
         
-class AggregateClassifications(luigi.Task):
+    def parts_dir(self):
+        # Returns the folder of the part files written in streamed mode.
+        return os.path.splitext(self.output().path)[0] + '-parts'
+    
+    def part(self, download_id):
+        # Returns the part file of the classifications of a download.
+        return luigi.LocalTarget(os.path.join(self.parts_dir(),
+            download_id + '.txt'))
+
+    def run_columnar(self):
+        with ExitStack() as stack:
+            outfile = stack.enter_context(self.output().open('w'))
+            raster_data = stack.enter_context(
+                rasterio.open(self.path_to_raster_data))
+            if self.radius:
+                schema = utils.get_schema('belt-distributions')
+            elif self.dedupe:
+                schema = utils.get_schema('classified-cells')
+            else:
+                schema = utils.get_schema('classifications')
+            writer = stack.enter_context(pq.ParquetWriter(outfile, schema,
+                compression='zstd'))
+            
+            band = self.read_band(stack, raster_data)
+            args = [raster_data.transform, band, self.limit]
+            results = self.classify(utils.classify_table, self.read_batches(),
+                args)
+            for table in results:
+                writer.write_table(table)
+                
+    def read_batches(self):
+        # Yields batches of 'rows_per_batch' occurrences from the Parquet file.
+        occurrences = pq.ParquetFile(self.input_occurrences().path)
+        count = occurrences.metadata.num_rows
+        batches = occurrences.iter_batches(self.rows_per_batch)
+        for i, batch in enumerate(batches):
+            message = 'Progress: {0:.0%}'.format(
+                i * self.rows_per_batch / count)
+            self.set_status_message(message)
+            print(message)
+            self.metrics.add_rows(batch.num_rows)
+            yield batch
+            
+    def read_band(self, stack, raster_data):
+        # Returns the band to classify against, as an array or, in windowed
+        # mode, as a WindowedBand closed with 'stack'. In radius mode, the
+        # memory-mapped belt tables are returned instead.
+        if self.radius:
+            return utils.load_belt_tables(self.input()[1].path)
+        if self.windowed:
+            return stack.enter_context(utils.WindowedBand(
+                self.path_to_raster_data, self.raster_cache_size))
+        return raster_data.read(1)
+    
+    def classify(self, classify_fn, blocks, args, pool=None):
+        # Applies one of the classify_block, classify_table, count_block or
+        # count_table functions to each block, in a pool of processes if
+        # 'processes' is above one. A pool started by utils.classification_pool
+        # can be passed to reuse it across calls.
+        if self.radius:
+            classify_fn = functools.partial(classify_fn, radius=True)
+        elif self.dedupe:
+            classify_fn = functools.partial(classify_fn, dedupe=True)
+        if pool:
+            return utils.classify_in_pool(pool, classify_fn, blocks,
+                                          self.processes)
+        if self.processes > 1:
+            return utils.classify_blocks_in_parallel(classify_fn, blocks,
+                *args, self.processes)
+        return (classify_fn(block, *args) for block in blocks)
+        
+        
+class ClassifyAndAggregateOccurrences(ClassifyOccurrences):
+    
+    # This task classifies the occurrences like ClassifyOccurrences and
+    # aggregates them like AggregateClassifications in a single pass. Each block
+    # is classified and counted by species key and belt, in the pool of
+    # processes if 'processes' is above one, so the classifications are never
+    # written out. Records are always classified in batch mode, from the
+    # consolidated archive.
+    
+    streamed = False
+    
+    def output(self):
+        return luigi.LocalTarget('data/agg-classifications.txt')
+    
+    def run(self):
+        with ExitStack() as stack:
+            outfile = stack.enter_context(self.output().open('w'))
+            raster_data = stack.enter_context(
+                rasterio.open(self.path_to_raster_data))
+            
+            if self.columnar:
+                blocks = self.read_batches()
+                count_fn = utils.count_table
+            else:
+                infile = stack.enter_context(
+                    self.input_occurrences().open('r'))
+                archive = stack.enter_context(ZipFile(infile, 'r'))
+                blocks = self.read_blocks(archive, archive.infolist())
+                count_fn = utils.count_block
+            band = self.read_band(stack, raster_data)
+            args = [raster_data.transform, band, self.limit]
+            counts = utils.BeltCounts(fractional=self.radius)
+            for block_counts in self.classify(count_fn, blocks, args):
+                counts.update(block_counts)
+            outfile.write(counts.to_frame().to_csv())
+            
+            
+class AggregateClassifications(InstrumentedTask):
 
     # This task groups the classified species keys and aggregates the classes
-    # (bioclimatic belts) based on their mode.
+    # (bioclimatic belts) based on their mode. The classifications are read
+    # 'rows_per_chunk' rows at a time and counted by species key and belt, and
+    # the count of each belt is written along with the mode. Classified cells
+    # are counted as many times as they occur. Belt distributions are counted
+    # once per occurrence, shared among the belts in proportion to their
+    # pixels, so the counts are fractional.
+
+    rows_per_chunk = 2**20
 
     def requires(self):
         return ClassifyOccurrences()
@@ -473,24 +1256,59 @@ class AggregateClassifications(luigi.Task):
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
             
-            names = ['Species Key','Belt']
-            df = pd.read_csv(infile, header=None, names=names)
-            grouped = df.groupby('Species Key')
-            aggregated = grouped.agg(lambda x: pd.Series.mode(x)[0])
-            aggregated.to_csv(outfile)
+            radius = self.requires().radius
+            counts = utils.BeltCounts(fractional=radius)
+            add = counts.add_distributions if radius else counts.add
+            if self.input().path.endswith('.parquet'):
+                batches = pq.ParquetFile(infile).iter_batches(
+                    self.rows_per_chunk)
+                for batch in batches:
+                    self.metrics.add_rows(batch.num_rows)
+                    add(*[batch.column(name).to_numpy(
+                        zero_copy_only=False) for name in batch.schema.names])
+            else:
+                names = ['Species Key','Belt']
+                if radius:
+                    names = utils.get_schema('belt-distributions').names
+                elif self.requires().dedupe:
+                    names.append('Count')
+                chunks = utils.read_csv_chunks(infile, names,
+                    self.rows_per_chunk)
+                for chunk in chunks:
+                    self.metrics.add_rows(len(chunk))
+                    add(*[chunk[name] for name in names])
+            outfile.write(counts.to_frame().to_csv())
             
             
-class ClassifySequences(luigi.Task):
+class ClassifySequences(InstrumentedTask):
 
     # This task performs a series of joins on the list of UIDs, Taxonomy IDs and
     # aggregated classified species keys to finally return a list of classified
-    # UIDs.
+    # UIDs. In incremental mode, the Taxonomy IDs and species keys of earlier
+    # runs are taken from the store, which is then updated with this run's.
+    # With 'fused', the aggregated classifications come from
+    # ClassifyAndAggregateOccurrences and classifications.txt is not written.
+    # With 'indexed', the species keys and belts are held in sorted arrays and
+    # the UIDs are streamed through them 'rows_per_chunk' rows at a time, so
+    # that memory grows with the number of distinct taxa rather than UIDs.
+    # The results are also published to the Results database.
+
+    fused = luigi.BoolParameter(default=False)
+    indexed = luigi.BoolParameter(default=False)
+    rows_per_chunk = 2**20
 
     def requires(self):
-        return [GetNuccoreSummaries(),
-                GBIFSpeciesMatch(),
-                AggregateClassifications()
-                ]
+        if self.fused:
+            aggregate = ClassifyAndAggregateOccurrences()
+        else:
+            aggregate = AggregateClassifications()
+        tasks = [GetNuccoreSummaries(),
+                 GBIFSpeciesMatch(),
+                 aggregate
+                 ]
+        if Store().incremental:
+            tasks += [RemoveDuplicateTaxIDs(), RemoveDuplicateSpeciesKeys()]
+        return tasks
     
     def output(self):
         return luigi.LocalTarget('data/classified-sequences.txt')
@@ -500,17 +1318,70 @@ class ClassifySequences(luigi.Task):
             infiles = [stack.enter_context(f.open('r')) for f in self.input()]
             outfile = stack.enter_context(self.output().open('w'))
             
+            results = None
+            if Results().publish:
+                store = stack.enter_context(utils.ResultStore(Results().path))
+                results = stack.enter_context(store.replace())
+            
+            df2 = utils.read_csv(infiles[1], names=['Taxonomy ID','Species Key'],
+                index_col=0)
+
+            df3 = pd.read_csv(infiles[2], usecols=['Species Key','Belt'],
+                index_col=0)
+            
+            if self.indexed:
+                self.join_indexed(stack, infiles, outfile, df2, df3, results)
+                return
+            
             df1 = pd.read_csv(infiles[0], header=None,
                 names=['UID','Taxonomy ID'], index_col=0)
-
-            df2 = pd.read_csv(infiles[1], header=None,
-                names=['Taxonomy ID','Species Key'], index_col=0)
-
-            df3 = pd.read_csv(infiles[2], index_col=0)
+            
+            if Store().incremental:
+                store = stack.enter_context(utils.SequenceStore(Store().path))
+                new_taxids = utils.read_csv(infiles[3], names=['Taxonomy ID'])
+                new_species_keys = utils.read_csv(infiles[4],
+                    names=['Species Key'])
+                store.update(df1, new_taxids.join(df2, on='Taxonomy ID'),
+                    new_species_keys.join(df3, on='Species Key'))
+                df2 = store.get_species_matches()
+                df3 = store.get_belts()
             
             first_join = df1.join(df2, on='Taxonomy ID', how='inner')
             second_join = first_join.join(df3, on='Species Key', how='inner')
-            second_join.to_csv(outfile)
+            outfile.write(second_join.to_csv())
+            if results:
+                results.insert(second_join.reset_index())
+    
+    def join_indexed(self, stack, infiles, outfile, df2, df3, results):
+        # This function writes the same joins as 'run' one chunk of UIDs at a
+        # time. In incremental mode the store is updated in a single
+        # transaction that is committed once every chunk has been written.
+        store = None
+        if Store().incremental:
+            store = stack.enter_context(utils.SequenceStore(Store().path))
+            stack.enter_context(store.connection)
+            new_taxa = utils.read_csv(infiles[3],
+                names=['Taxonomy ID']).join(df2, on='Taxonomy ID')
+            new_species = utils.read_csv(infiles[4],
+                names=['Species Key']).join(df3, on='Species Key')
+            store.insert('taxa', new_taxa['Taxonomy ID'],
+                new_taxa['Species Key'])
+            store.insert('species', new_species['Species Key'],
+                new_species['Belt'])
+            df2 = store.get_species_matches()
+            df3 = store.get_belts()
+        
+        species_keys = utils.SortedLookup(df2.index, df2['Species Key'])
+        belts = utils.SortedLookup(df3.index, df3['Belt'])
+        chunks = utils.read_csv_chunks(infiles[0], ['UID','Taxonomy ID'],
+            self.rows_per_chunk)
+        for i, chunk in enumerate(chunks):
+            if store:
+                store.insert('sequences', chunk['UID'], chunk['Taxonomy ID'])
+            joined = utils.join_sequences(chunk, species_keys, belts)
+            outfile.write(joined.to_csv(header=(i == 0), index=False))
+            if results:
+                results.insert(joined)
             
             
 class RunAllTasks(luigi.WrapperTask):
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'results.db')
+        self.sequences = pd.DataFrame({'UID':[2, 1], 'Taxonomy ID':[20, 10],
+                                       'Species Key':[200, 100], 'Belt':[3, 3]})
+        with utils.ResultStore(self.path) as store:
+            with store.replace():
+                store.insert(self.sequences)
+
+    def index_names(self):
+        with closing(sqlite3.connect(self.path)) as connection:
+            rows = connection.execute("SELECT name FROM sqlite_master WHERE "
+                                      "type = 'index' AND name NOT LIKE "
+                                      "'sqlite_%' ORDER BY name").fetchall()
+        return [name for name, in rows]
+
+    def test_replace_rolls_back_index_drops(self):
+        with utils.ResultStore(self.path) as store:
+            with self.assertRaises(RuntimeError):
+                with store.replace():
+                    store.insert(self.sequences.assign(Belt=5))
+                    raise RuntimeError
+        self.assertEqual(self.index_names(), ['classified_sequences_belt',
+                                              'classified_sequences_skey'])
+        with closing(sqlite3.connect(self.path)) as connection:
+            self.assertEqual(connection.execute(
+                'SELECT * FROM belt_counts').fetchall(), [(3, 2, 2)])
+
+    def test_readers_keep_indexes_during_replace(self):
+        with utils.ResultStore(self.path) as store:
+            with store.replace():
+                store.insert(self.sequences)
+                self.assertEqual(len(self.index_names()), 2)
+        self.assertEqual(len(self.index_names()), 2)
+
+
+class EmptyHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class InstrumentedSessionTest(unittest.TestCase):
+
+    def test_latency_excludes_rate_limit_wait(self):
+        server = HTTPServer(('127.0.0.1', 0), EmptyHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+        metrics = utils.TaskMetrics()
+        with utils.InstrumentedSession(metrics) as s:
+            utils.mount_shared_pool(s, url, 0, 1, rate=10)
+            for i in range(5):
+                s.get(url + 'ping', timeout=5)
+        endpoint, = metrics.summary()['http']
+        self.assertGreater(endpoint['rate_limit_wait_seconds'], 0.3)
+        self.assertLess(endpoint['latency_seconds'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,83 @@ Created on Wed May 22 20:30:41 2019
 @author: benja
 """
 import requests
-import shutil
+import urllib3
+import csv
+import io
+import os
+import tempfile
+import collections
+import heapq
+import functools
+import hashlib
+import base64
+import copy
+import struct
+import zipfile
+import json
+import bisect
+import itertools
+import re
+import sys
+import urllib.parse
+import math
+import queue
+import sqlite3
+import threading
+import time
+import contextlib
+import importlib
+import difflib
 from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import resource
+except ImportError: # Not available on Windows.
+    resource = None
+
+class LazyModule:
+    # This class stands in for a module that is only imported when one of its
+    # attributes is first used, so that tasks which never touch NumPy, pandas,
+    # rasterio or pyarrow start without loading them. The attributes of the
+    # module are then copied onto the stand-in.
+    
+    def __init__(self, name):
+        self.__name__ = name
+        
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+    
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+rasterio = LazyModule('rasterio')
+pa = LazyModule('pyarrow') # Only needed for the columnar format.
+
+ESUMMARY_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
+
+# Column indexes of the latitude, longitude, coordinate uncertainty and species
+# key fields in a GBIF SIMPLE_CSV occurrence file.
+OCCURRENCE_COLUMNS = {'y':16, 'x':17, 'coord_uncertainty':18, 'skey':29}
+
+@functools.lru_cache(maxsize=None)
+def get_schema(name):
+    # This function returns the schema of the columnar 'occurrences',
+    # 'classifications', 'classified-cells' or 'belt-distributions' files.
+    if name == 'occurrences':
+        return pa.schema([('decimalLatitude', pa.float64()),
+                          ('decimalLongitude', pa.float64()),
+                          ('coordinateUncertaintyInMeters', pa.float64()),
+                          ('speciesKey', pa.int64())])
+    if name == 'belt-distributions':
+        return pa.schema([('Species Key', pa.int64())]
+            + [('Belt {} Pixels'.format(belt), pa.uint32())
+               for belt in range(1, BeltCounts.belts + 1)])
+    schema = pa.schema([('Species Key', pa.int64()),
+                        ('Belt', pa.uint8())])
+    if name == 'classified-cells':
+        schema = schema.append(pa.field('Count', pa.int64()))
+    return schema
 
 def generate_query_expression(data):
     # This function generates a JSON query expression that is used in a POST
@@ -46,9 +121,11 @@ def generate_query_expression(data):
     }            
     return expression
 
-def prep_esummary_req(query_key, webenv, retstart, retmax, db, api_key):
+def prep_esummary_req(query_key, webenv, retstart, retmax, db, api_key,
+                      url=ESUMMARY_URL, session=None):
     # This function generates a query string to be sent along with a GET
-    # request to the Entrez ESummary utility.    
+    # request to the Entrez ESummary utility. Given a session, the request
+    # also gets its default headers, such as Accept-Encoding.
     payload = {'query_key':query_key,
                'webenv':webenv,
                'version':'2.0',
@@ -58,12 +135,787 @@ def prep_esummary_req(query_key, webenv, retstart, retmax, db, api_key):
                'db':db,
                'api_key':api_key
                }
-    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
     req = requests.Request('GET', url, params=payload)
-    prepped = req.prepare()
-    prepped.headers['Accept-Encoding'] = 'identity' # Chunked encoding error fix.
-    return prepped
+    if session is not None:
+        return session.prepare_request(req)
+    return req.prepare()
+        
+class RateLimiter:
+    # This class is a thread-safe token bucket that lets callers through at an
+    # average of 'rate' calls per second with bursts of up to 'capacity' calls.
+    
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def acquire(self):
+        # Takes a token, sleeping until one becomes available, and returns the
+        # seconds slept. Tokens may be reserved ahead of time so waiting
+        # callers are served in order.
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0
+
+def peak_rss():
+    # This function returns the peak resident set size in bytes of this
+    # process and of its finished child processes, or None where unknown.
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024 # Kilobytes on Linux.
+    return {who:getattr(resource.getrusage(getattr(resource, who)),
+                        'ru_maxrss') * scale
+            for who in ['RUSAGE_SELF', 'RUSAGE_CHILDREN']}
+
+class TaskMetrics:
+    # This class is a thread-safe record of a task run: HTTP request counts by
+    # status, latency histograms, time spent waiting on rate limits, bytes sent
+    # and received and retries, all by endpoint, plus the number of rows
+    # processed. It is written out as JSON or in the Prometheus text format,
+    # along with wall and CPU time and peak resident set size.
+    
+    # Upper bounds in seconds of the latency histogram buckets.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, float('inf'))
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.requests = collections.Counter() # (Method, endpoint, status).
+        self.errors = collections.Counter() # (Method, endpoint).
+        self.latency = {} # (Method, endpoint) -> bucket counts.
+        self.latency_sum = collections.Counter()
+        self.rate_limit_wait = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self.bytes_received = collections.Counter()
+        self.retries = collections.Counter()
+        self.rows = 0
+        self.lock = threading.Lock()
+        
+    @staticmethod
+    def endpoint(url):
+        # Returns the host and path of a URL with path segments holding runs of
+        # three or more digits (such as download IDs) replaced by '{id}'.
+        parts = urllib.parse.urlsplit(url)
+        path = re.sub(r'/[^/]*\d{3}[^/]*', '/{id}', parts.path)
+        return parts.netloc + path
+        
+    def record_request(self, method, url, status, seconds, sent, received,
+                       retries, waited=0):
+        key = (method, self.endpoint(url))
+        with self.lock:
+            self.requests[key + (status,)] += 1
+            counts = self.latency.setdefault(key, [0] * len(self.buckets))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.latency_sum[key] += seconds
+            self.rate_limit_wait[key] += waited
+            self.bytes_sent[key] += sent
+            self.bytes_received[key] += received
+            self.retries[key] += retries
+            
+    def record_error(self, method, url):
+        with self.lock:
+            self.errors[method, self.endpoint(url)] += 1
+            
+    def add_rows(self, rows):
+        with self.lock:
+            self.rows += rows
+            
+    def summary(self):
+        # Returns the metrics as a dictionary.
+        seconds = time.perf_counter() - self.started
+        with self.lock:
+            endpoints = []
+            for key, counts in sorted(self.latency.items()):
+                statuses = {str(status):n for (*k, status), n
+                            in self.requests.items() if tuple(k) == key}
+                endpoints.append({'method':key[0], 'endpoint':key[1],
+                    'requests':statuses,
+                    'errors':self.errors[key],
+                    'latency_buckets':dict(zip(map(str, self.buckets),
+                                               itertools.accumulate(counts))),
+                    'latency_seconds':self.latency_sum[key],
+                    'rate_limit_wait_seconds':self.rate_limit_wait[key],
+                    'bytes_sent':self.bytes_sent[key],
+                    'bytes_received':self.bytes_received[key],
+                    'retries':self.retries[key]})
+            for key in sorted(set(self.errors) - set(self.latency)):
+                endpoints.append({'method':key[0], 'endpoint':key[1],
+                                  'requests':{}, 'errors':self.errors[key]})
+            return {'wall_seconds':seconds,
+                    'cpu_seconds':time.process_time() - self.cpu_started,
+                    'peak_rss_bytes':peak_rss(),
+                    'rows':self.rows,
+                    'rows_per_second':self.rows / seconds if seconds else 0,
+                    'http':endpoints}
+        
+    def to_prometheus(self, labels):
+        # Returns the metrics in the Prometheus text format, each with the
+        # given labels (such as the task family). Samples are grouped by metric
+        # family, as the format requires.
+        summary = self.summary()
+        families = collections.OrderedDict() # Name -> (type, samples).
+        def add(family, kind, value, suffix='', **extra):
+            pairs = dict(labels, **extra)
+            text = ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                            for k, v in pairs.items())
+            samples = families.setdefault(family, (kind, []))[1]
+            samples.append('ginseng_{0}{1}{{{2}}} {3}\n'.format(family, suffix,
+                                                              text, value))
+        add('task_wall_seconds', 'gauge', summary['wall_seconds'])
+        add('task_cpu_seconds', 'gauge', summary['cpu_seconds'])
+        add('task_rows_total', 'counter', summary['rows'])
+        add('task_rows_per_second', 'gauge', summary['rows_per_second'])
+        for who, value in (summary['peak_rss_bytes'] or {}).items():
+            process = 'self' if who == 'RUSAGE_SELF' else 'children'
+            add('task_peak_rss_bytes', 'gauge', value, process=process)
+        for e in summary['http']:
+            request = {'method':e['method'], 'endpoint':e['endpoint']}
+            for status, n in e['requests'].items():
+                add('http_requests_total', 'counter', n, status=status,
+                    **request)
+            add('http_errors_total', 'counter', e['errors'], **request)
+            if 'latency_buckets' not in e:
+                continue
+            for le, n in e['latency_buckets'].items():
+                le = '+Inf' if le == 'inf' else le
+                add('http_request_seconds', 'histogram', n, '_bucket', le=le,
+                    **request)
+            add('http_request_seconds', 'histogram', e['latency_seconds'],
+                '_sum', **request)
+            add('http_request_seconds', 'histogram',
+                sum(e['requests'].values()), '_count', **request)
+            add('http_rate_limit_wait_seconds_total', 'counter',
+                e['rate_limit_wait_seconds'], **request)
+            for name in ['bytes_sent', 'bytes_received', 'retries']:
+                add('http_{}_total'.format(name), 'counter', e[name],
+                    **request)
+        return ''.join('# TYPE ginseng_{0} {1}\n'.format(family, kind)
+                       + ''.join(samples)
+                       for family, (kind, samples) in families.items())
+
+class InstrumentedSession(requests.Session):
+    # This class is a requests session that records every request it sends,
+    # including redirects, in a TaskMetrics. The latency excludes the time
+    # spent waiting on the rate limiter of a SharedPoolAdapter, which is
+    # recorded separately. Retries are those made by the urllib3 Retry of the
+    # mounted adapter. A GET whose response body is cut short or cannot be
+    # decoded, as chunked responses from NCBI sometimes are, is sent again up
+    # to 'read_attempts' times in all.
+    
+    read_attempts = 3
+    
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
         
+    def send(self, request, **kwargs):
+        for attempt in range(self.read_attempts):
+            start = time.perf_counter()
+            try:
+                r = super().send(request, **kwargs)
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError):
+                self.metrics.record_error(request.method, request.url)
+                if request.method != 'GET' or attempt == self.read_attempts - 1:
+                    raise
+                continue
+            except requests.RequestException:
+                self.metrics.record_error(request.method, request.url)
+                raise
+            break
+        # The body of a streamed response has not been read yet. Otherwise the
+        # bytes read from the network are counted, before any decompression.
+        if kwargs.get('stream'):
+            received = int(r.headers.get('Content-Length', 0))
+        else:
+            received = r.raw.tell() if hasattr(r.raw, 'tell') else len(r.content)
+        retries = getattr(r.raw, 'retries', None)
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        waited = sum(getattr(hop, 'rate_limit_wait', 0)
+                     for hop in r.history + [r])
+        self.metrics.record_request(request.method, request.url, r.status_code,
+            time.perf_counter() - start - waited, len(body), received,
+            len(retries.history) if retries else 0, waited)
+        return r
+
+class HostPool:
+    # This class holds the connection pool for a host, with room for 'size'
+    # idle connections, and its rate limit in requests per second, if any.
+    
+    def __init__(self, size):
+        self.size = size
+        self.poolmanager = urllib3.PoolManager(maxsize=size)
+        self.limiter = None
+        self.pid = os.getpid()
+        
+    def set_rate(self, rate):
+        if rate is None:
+            self.limiter = None
+        elif self.limiter is None:
+            self.limiter = RateLimiter(rate)
+        else:
+            self.limiter.rate = rate
+
+class SharedPoolAdapter(requests.adapters.HTTPAdapter):
+    # This class is a transport adapter that sends requests through the shared
+    # connection pool of a host, waiting on its rate limiter before each one.
+    # The seconds waited are kept in the 'rate_limit_wait' of the response.
+    # Closing the adapter, as closing its session does, leaves the pool open so
+    # that its connections are kept alive for later sessions.
+    
+    def __init__(self, pool, max_retries):
+        self.pool = pool
+        super().__init__(max_retries=max_retries)
+        
+    def init_poolmanager(self, *args, **kwargs):
+        self.poolmanager = self.pool.poolmanager
+        
+    def send(self, request, **kwargs):
+        waited = self.pool.limiter.acquire() if self.pool.limiter else 0
+        r = super().send(request, **kwargs)
+        r.rate_limit_wait = waited
+        return r
+    
+    def close(self):
+        for proxy in self.proxy_manager.values():
+            proxy.clear()
+
+_host_pools = {}
+_host_pools_lock = threading.Lock()
+
+def mount_shared_pool(session, url, max_retries, size, rate=None):
+    # This function mounts an adapter for the URL prefix 'url' on a session
+    # that uses the connection pool and rate limit shared by all sessions of
+    # this process talking to the URL's host. The pool is replaced by a larger
+    # one if it has room for fewer than 'size' connections, and the host's
+    # rate limit is set to 'rate' requests per second (None for no limit).
+    # Pools are not shared with forked processes.
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_pools_lock:
+        pool = _host_pools.get(host)
+        if pool is None or pool.pid != os.getpid() or pool.size < size:
+            limiter = pool.limiter if pool else None
+            pool = _host_pools[host] = HostPool(size)
+            pool.limiter = limiter
+        pool.set_rate(rate)
+    session.mount(url, SharedPoolAdapter(pool, max_retries))
+
+def get_esummary_pages(session, url, shards, retmax, db, api_key, timeout,
+                       concurrency):
+    # This function pages through the results of one or more queries on the
+    # Entrez History Server, given as (query key, web environment, count)
+    # shards, with up to 'concurrency' ESummary requests in flight across all
+    # of them. Yields (retstart, response) pairs in shard and retstart order.
+    pages = [(query_key, webenv, retstart)
+             for query_key, webenv, count in shards
+             for retstart in range(0, count, retmax)]
+    def get_page(page):
+        query_key, webenv, retstart = page
+        args = [query_key, webenv, retstart, retmax, db, api_key, url, session]
+        prepped = prep_esummary_req(*args)
+        return retstart, session.send(prepped, timeout=timeout, stream=False)
+    with ThreadPoolExecutor(concurrency) as executor:
+        yield from map_bounded(executor, get_page, pages, 2 * concurrency)
+        
+class SpeciesMatchCache:
+    # This class is an SQLite cache of GBIF species/match results keyed by the
+    # name, kingdom and strict parameters of the request. Entries older than
+    # 'ttl' seconds are treated as missing.
+    
+    commit_every = 100
+    
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS species_match ('
+            'name TEXT, kingdom TEXT, strict TEXT, result TEXT, updated REAL, '
+            'PRIMARY KEY (name, kingdom, strict))')
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def get(self, payload):
+        # Returns the cached result for a request payload or None.
+        args = (payload['name'], payload['kingdom'], payload['strict'],
+                time.time() - self.ttl)
+        row = self.connection.execute(
+            'SELECT result FROM species_match WHERE name = ? AND kingdom = ? '
+            'AND strict = ? AND updated >= ?', args).fetchone()
+        if row:
+            return json.loads(row[0])
+        
+    def put(self, payload, result):
+        # Stores the result for a request payload, replacing any older entry.
+        args = (payload['name'], payload['kingdom'], payload['strict'],
+                json.dumps(result), time.time())
+        self.connection.execute(
+            'INSERT OR REPLACE INTO species_match VALUES (?, ?, ?, ?, ?)', args)
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.connection.commit()
+            self.pending = 0
+            
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+# Rank markers and hybrid signs dropped from scientific names before they are
+# matched against the canonical names of the GBIF Backbone Taxonomy.
+NAME_MARKERS = {'x', 'subsp.', 'ssp.', 'var.', 'subvar.', 'f.',
+                'fo.', 'forma', 'subf.', 'cv.', 'convar.'}
+
+def normalize_name(name):
+    # This function lowercases a scientific name and strips it of quotes,
+    # brackets, rank markers and hybrid signs, so that NCBI names compare
+    # equal to GBIF canonical names.
+    words = re.sub('[\'"()\\[\\]\u00d7]', ' ', name).lower().split()
+    return ' '.join(word for word in words if word not in NAME_MARKERS)
+
+class BackboneIndex:
+    # This class is an SQLite index of the names in a GBIF Backbone Taxonomy
+    # dump, each mapped to the key of its accepted species: synonyms are
+    # replaced by their accepted names and infraspecific taxa are rolled up to
+    # their species. Names shared by taxa of different species, after
+    # preferring accepted names to synonyms, are kept without a species key
+    # so that they are never matched.
+    
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.genera = {}
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.connection.close()
+        
+    def build(self, taxon_file, kingdom, ranks):
+        # Builds the index from the Taxon.tsv file of a dump, given as an open
+        # binary file, keeping the taxa of 'kingdom' with one of 'ranks'.
+        # Returns the number of taxa read.
+        text = io.TextIOWrapper(taxon_file, encoding='utf-8')
+        reader = csv.reader(text, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(reader)
+        columns = [header.index(name) for name in ['taxonID',
+            'canonicalName', 'taxonRank', 'parentNameUsageID',
+            'acceptedNameUsageID', 'kingdom']]
+        ranks = set(rank.upper() for rank in ranks)
+        
+        def read_taxa():
+            for row in reader:
+                taxon_id, name, rank, parent, accepted, taxon_kingdom = [
+                    row[i] for i in columns]
+                rank = rank.upper()
+                if taxon_kingdom == kingdom and rank in ranks and name:
+                    yield (int(taxon_id), normalize_name(name), rank,
+                           int(parent) if parent else None,
+                           int(accepted) if accepted else None)
+        
+        with self.connection:
+            self.connection.executescript(
+                'DROP TABLE IF EXISTS taxa; DROP TABLE IF EXISTS names;'
+                'CREATE TABLE taxa (id INTEGER PRIMARY KEY, name TEXT, '
+                'rank TEXT, parent INTEGER, accepted INTEGER, skey INTEGER);')
+            self.connection.executemany(
+                'INSERT INTO taxa VALUES (?, ?, ?, ?, ?, NULL)', read_taxa())
+            self.connection.execute("UPDATE taxa SET skey = id "
+                "WHERE accepted IS NULL AND rank = 'SPECIES'")
+            # Infraspecific taxa take the species key of their parent, which
+            # may itself be infraspecific.
+            while self.connection.execute('UPDATE taxa SET skey = '
+                    '(SELECT p.skey FROM taxa p WHERE p.id = taxa.parent) '
+                    'WHERE skey IS NULL AND accepted IS NULL AND parent IN '
+                    '(SELECT id FROM taxa WHERE skey IS NOT NULL)').rowcount:
+                pass
+            self.connection.executescript(
+                'UPDATE taxa SET skey = (SELECT a.skey FROM taxa a '
+                'WHERE a.id = taxa.accepted) WHERE accepted IS NOT NULL;'
+                'CREATE INDEX taxa_name ON taxa (name, accepted);'
+                'CREATE TABLE names (name TEXT PRIMARY KEY, skey INTEGER) '
+                'WITHOUT ROWID;'
+                'INSERT INTO names SELECT name, CASE WHEN COUNT(DISTINCT skey) '
+                '= 1 THEN MIN(skey) END FROM taxa t WHERE skey IS NOT NULL '
+                'AND (accepted IS NULL OR NOT EXISTS (SELECT 1 FROM taxa a '
+                'WHERE a.name = t.name AND a.accepted IS NULL '
+                'AND a.skey IS NOT NULL)) GROUP BY name;'
+                'DROP TABLE taxa;')
+        self.connection.execute('VACUUM')
+        return reader.line_num - 1
+    
+    def get_genus(self, genus):
+        # Returns the matchable names of a genus and their species keys.
+        if genus not in self.genera:
+            rows = self.connection.execute('SELECT name, skey FROM names '
+                'WHERE name > ? AND name < ? AND skey IS NOT NULL',
+                (genus + ' ', genus + '!'))
+            self.genera[genus] = dict(rows)
+        return self.genera[genus]
+        
+    def match(self, name, cutoff):
+        # Returns the species key of a scientific name and the type of match,
+        # 'EXACT', 'FUZZY' or 'NONE' (with a species key of None). A name
+        # missing from the index is matched to the most similar name of the
+        # same genus with a similarity of at least 'cutoff'.
+        name = normalize_name(name)
+        row = self.connection.execute('SELECT skey FROM names WHERE name = ?',
+            (name,)).fetchone()
+        if row:
+            return (row[0], 'EXACT') if row[0] else (None, 'NONE')
+        genus = self.get_genus(name.split(' ', 1)[0])
+        close = difflib.get_close_matches(name, genus, n=1, cutoff=cutoff)
+        if close:
+            return genus[close[0]], 'FUZZY'
+        return None, 'NONE'
+
+# Files of an NCBI taxdump archive read by TaxdumpIndex.
+TAXDUMP_FILES = ['names.dmp', 'merged.dmp', 'delnodes.dmp']
+
+def read_dmp(binary):
+    # This function yields the fields of each line of an NCBI taxdump file.
+    for line in io.TextIOWrapper(binary, encoding='utf-8'):
+        yield [field.strip() for field in line.split('\t|')[:-1]]
+
+class TaxdumpIndex:
+    # This class is an SQLite index of the scientific names of an NCBI taxdump
+    # archive, keyed by Taxonomy ID, with the Taxonomy IDs merged into others
+    # and those deleted.
+    
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.connection.close()
+        
+    def build(self, members):
+        # Builds the index from the files in TAXDUMP_FILES, given as pairs of
+        # file names and open binary files in any order. Returns the number of
+        # scientific names indexed.
+        rows = {'names.dmp':lambda fields: (int(fields[0]), fields[1])
+                    if fields[3] == 'scientific name' else None,
+                'merged.dmp':lambda fields: (int(fields[0]), int(fields[1])),
+                'delnodes.dmp':lambda fields: (int(fields[0]),)}
+        queries = {'names.dmp':'INSERT INTO names VALUES (?, ?)',
+                   'merged.dmp':'INSERT INTO merged VALUES (?, ?)',
+                   'delnodes.dmp':'INSERT INTO deleted VALUES (?)'}
+        with self.connection:
+            self.connection.executescript(
+                'DROP TABLE IF EXISTS names; DROP TABLE IF EXISTS merged;'
+                'DROP TABLE IF EXISTS deleted;'
+                'CREATE TABLE names (taxid INTEGER PRIMARY KEY, name TEXT);'
+                'CREATE TABLE merged (taxid INTEGER PRIMARY KEY, '
+                'new_taxid INTEGER);'
+                'CREATE TABLE deleted (taxid INTEGER PRIMARY KEY);')
+            for name, binary in members:
+                values = map(rows[name], read_dmp(binary))
+                self.connection.executemany(queries[name], filter(None, values))
+        row = self.connection.execute('SELECT COUNT(*) FROM names').fetchone()
+        return row[0]
+    
+    def resolve(self, taxids):
+        # Looks up a list of Taxonomy IDs in a single query. Returns a list of
+        # pairs of Taxonomy IDs and scientific names in the same order, with
+        # the number of Taxonomy IDs that were merged and deleted. Merged
+        # Taxonomy IDs are given the name of the taxon they were merged into,
+        # and deleted or unknown ones are left out.
+        with self.connection:
+            self.connection.executescript(
+                'DROP TABLE IF EXISTS temp.requested;'
+                'CREATE TEMP TABLE requested (position INTEGER PRIMARY KEY, '
+                'taxid INTEGER);')
+            self.connection.executemany('INSERT INTO requested (taxid) '
+                'VALUES (?)', ((int(taxid),) for taxid in taxids))
+            names = self.connection.execute('SELECT r.taxid, n.name '
+                'FROM requested r LEFT JOIN merged m ON m.taxid = r.taxid '
+                'JOIN names n ON n.taxid = COALESCE(m.new_taxid, r.taxid) '
+                'ORDER BY r.position').fetchall()
+            query = ('SELECT COUNT(*) FROM requested r JOIN {0} t '
+                     'ON t.taxid = r.taxid')
+            merged, deleted = [self.connection.execute(query.format(table))
+                .fetchone()[0] for table in ['merged', 'deleted']]
+            self.connection.execute('DROP TABLE temp.requested')
+        return names, merged, deleted
+
+class SequenceStore:
+    # This class is an SQLite store of the UIDs, Taxonomy IDs, species keys and
+    # belts resolved by earlier pipeline runs. Taxonomy IDs without a species
+    # match and species keys without a belt are stored with NULLs so that they
+    # are not looked up again.
+    
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(
+                'CREATE TABLE IF NOT EXISTS sequences ('
+                'uid INTEGER PRIMARY KEY, taxid INTEGER);'
+                'CREATE TABLE IF NOT EXISTS taxa ('
+                'taxid INTEGER PRIMARY KEY, skey INTEGER);'
+                'CREATE TABLE IF NOT EXISTS species ('
+                'skey INTEGER PRIMARY KEY, belt INTEGER);')
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.connection.close()
+        
+    def get_taxids(self):
+        # Returns the set of stored Taxonomy IDs as strings.
+        rows = self.connection.execute('SELECT taxid FROM taxa')
+        return set(str(taxid) for taxid, in rows)
+    
+    def get_species_keys(self):
+        # Returns the set of stored species keys as strings.
+        rows = self.connection.execute('SELECT skey FROM species')
+        return set(str(skey) for skey, in rows)
+    
+    def get_species_matches(self):
+        # Returns the matched Taxonomy IDs and species keys as a data frame
+        # indexed by Taxonomy ID.
+        return pd.read_sql('SELECT taxid AS "Taxonomy ID", skey AS "Species Key" '
+            'FROM taxa WHERE skey IS NOT NULL', self.connection,
+            index_col='Taxonomy ID')
+    
+    def get_belts(self):
+        # Returns the classified species keys and belts as a data frame indexed
+        # by species key.
+        return pd.read_sql('SELECT skey AS "Species Key", belt AS "Belt" '
+            'FROM species WHERE belt IS NOT NULL', self.connection,
+            index_col='Species Key')
+    
+    def insert(self, table, keys, values):
+        # Adds rows to one of the tables without committing them. Missing
+        # values are NaN.
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(table),
+            zip(to_nullable_ints(keys), to_nullable_ints(values)))
+    
+    def update(self, sequences, taxa, species):
+        # Adds the UIDs and Taxonomy IDs of a run, with the species keys of its
+        # new Taxonomy IDs and the belts of its new species keys, in a single
+        # transaction. Unmatched and unclassified values are NaN.
+        with self.connection:
+            self.insert('sequences', sequences.index, sequences['Taxonomy ID'])
+            self.insert('taxa', taxa['Taxonomy ID'], taxa['Species Key'])
+            self.insert('species', species['Species Key'], species['Belt'])
+
+class ResultStore:
+    # This class is an SQLite store of the classified sequences of the latest
+    # run, indexed by UID, species key and belt, with the number of sequences
+    # and species classified into each belt. The results are swapped in a
+    # single transaction opened with 'replace', so readers see either the
+    # previous or the new ones. The secondary indexes are dropped while the
+    # results are inserted and built again at the end, which is much faster
+    # than keeping them up to date row by row. The belt index also covers the
+    # species keys, so that the belts are counted from it alone.
+    
+    indexes = ('CREATE INDEX IF NOT EXISTS classified_sequences_skey '
+               'ON classified_sequences (skey);'
+               'CREATE INDEX IF NOT EXISTS classified_sequences_belt '
+               'ON classified_sequences (belt, skey);')
+    
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(
+                'CREATE TABLE IF NOT EXISTS classified_sequences ('
+                'uid INTEGER PRIMARY KEY, taxid INTEGER, skey INTEGER, '
+                'belt INTEGER);' + self.indexes +
+                'CREATE TABLE IF NOT EXISTS belt_counts ('
+                'belt INTEGER PRIMARY KEY, sequences INTEGER, '
+                'species INTEGER);')
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.connection.close()
+        
+    @contextlib.contextmanager
+    def replace(self):
+        # Deletes the stored results, lets the caller insert the new ones and
+        # then counts them by belt and commits. Nothing is changed if the
+        # caller raises an exception. The transaction is opened explicitly, as
+        # sqlite3 would otherwise commit the index drops straight away.
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute(
+                'DROP INDEX IF EXISTS classified_sequences_skey')
+            self.connection.execute(
+                'DROP INDEX IF EXISTS classified_sequences_belt')
+            self.connection.execute('DELETE FROM classified_sequences')
+            self.connection.execute('DELETE FROM belt_counts')
+            yield self
+            for statement in self.indexes.split(';')[:-1]:
+                self.connection.execute(statement)
+            self.connection.execute(
+                'INSERT INTO belt_counts SELECT belt, COUNT(*), '
+                'COUNT(DISTINCT skey) FROM classified_sequences GROUP BY belt')
+    
+    def insert(self, sequences):
+        # Adds a data frame of UIDs, Taxonomy IDs, species keys and belts. The
+        # rows are inserted in UID order, which keeps the table's B-tree
+        # updates local.
+        columns = ['UID','Taxonomy ID','Species Key','Belt']
+        sequences = sequences.sort_values('UID')
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO classified_sequences VALUES (?, ?, ?, ?)',
+            zip(*[to_nullable_ints(sequences[column]) for column in columns]))
+
+def to_nullable_ints(values):
+    # This function converts an array of numbers to a list of Python integers
+    # in which NaN becomes None.
+    values = pd.Series(values).astype('Int64').astype(object)
+    return values.where(values.notna(), None).tolist()
+
+def read_csv(infile, names, index_col=None):
+    # This function reads a CSV file without a header like pd.read_csv, except
+    # that an empty file gives an empty data frame of integer columns.
+    try:
+        df = pd.read_csv(infile, header=None, names=names)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame({name:pd.Series(dtype='int64') for name in names})
+    if index_col is not None:
+        df = df.set_index(names[index_col])
+    return df
+
+def read_csv_chunks(infile, names, chunksize):
+    # This function is like 'read_csv' but yields the file in data frames of
+    # 'chunksize' rows.
+    try:
+        yield from pd.read_csv(infile, header=None, names=names,
+                               chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        yield pd.DataFrame({name:pd.Series(dtype='int64') for name in names})
+
+class SortedLookup:
+    # This class maps integer keys to values with an array of unique keys in
+    # sorted order and an array of values in the same order, for joins that
+    # need memory in proportion to the number of keys only.
+    
+    def __init__(self, keys, values):
+        keys = np.asarray(keys, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.values = np.asarray(values)[order]
+        
+    def get(self, keys):
+        # Returns a mask of the keys that were found and an array of their
+        # values, in which the values of keys not found are meaningless.
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys),
+                dtype=self.values.dtype)
+        indexes = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        return self.keys[indexes] == keys, self.values[indexes]
+    
+def join_sequences(sequences, species_keys, belts):
+    # This function joins a data frame of UIDs and Taxonomy IDs to species
+    # keys and then belts, given as SortedLookups, keeping the rows matched by
+    # both like a pair of inner joins.
+    found, values = species_keys.get(sequences['Taxonomy ID'])
+    sequences = sequences[found].assign(**{'Species Key':values[found]})
+    found, values = belts.get(sequences['Species Key'])
+    return sequences[found].assign(Belt=values[found])
+
+class BeltCounts:
+    # This class counts the classified occurrences of each species key by belt
+    # (1 to 7) in a sorted array of species keys and an array of counts with a
+    # row per species key. Classifications can be added a chunk at a time and
+    # the memory used depends on the number of species only. With
+    # 'fractional', the counts are floats, so that occurrences can be shared
+    # among belts.
+    
+    belts = 7
+    
+    def __init__(self, fractional=False):
+        dtype = np.float64 if fractional else np.int64
+        self.species_keys = np.empty(0, dtype=np.int64)
+        self.counts = np.zeros((0, self.belts), dtype=dtype)
+        
+    def add(self, species_keys, belts, weights=None):
+        # Adds arrays of species keys and belts, each pair counted 'weights'
+        # times if given. Missing species keys are skipped, as they are by
+        # 'groupby'.
+        species_keys = pd.Series(species_keys)
+        known = species_keys.notna().to_numpy()
+        species_keys = species_keys[known].to_numpy(dtype=np.int64)
+        belts = np.asarray(belts)[known].astype(np.int64)
+        if weights is not None:
+            weights = np.asarray(weights)[known]
+        if np.any((belts < 1) | (belts > self.belts)):
+            raise ValueError('Belts must be between 1 and {}'.format(self.belts))
+        keys, rows = np.unique(species_keys, return_inverse=True)
+        counts = np.bincount(rows * self.belts + belts - 1, weights,
+            minlength=len(keys) * self.belts).reshape(-1, self.belts)
+        self.add_counts(keys, counts.astype(self.counts.dtype))
+        
+    def add_distributions(self, species_keys, *pixels):
+        # Adds an array of species keys and an array per belt of the pixels of
+        # that belt around each occurrence. Each occurrence is counted once,
+        # shared among the belts in proportion to their pixels, so the counts
+        # must be fractional. Occurrences without a species key or any pixels
+        # are skipped.
+        pixels = np.column_stack(pixels).astype(np.float64)
+        totals = pixels.sum(axis=1)
+        species_keys = pd.Series(species_keys)
+        known = species_keys.notna().to_numpy() & (totals > 0)
+        keys, rows = np.unique(species_keys[known].to_numpy(dtype=np.int64),
+                               return_inverse=True)
+        shares = pixels[known] / totals[known, np.newaxis]
+        counts = np.column_stack([np.bincount(rows, shares[:, belt],
+            minlength=len(keys)) for belt in range(self.belts)])
+        self.add_counts(keys, counts.reshape(-1, self.belts))
+        
+    def add_counts(self, species_keys, counts):
+        # Adds the rows of counts of a sorted array of unique species keys.
+        if not np.array_equal(species_keys, self.species_keys):
+            keys = np.union1d(self.species_keys, species_keys)
+            if len(keys) > len(self.species_keys):
+                expanded = np.zeros((len(keys), self.belts),
+                                    dtype=self.counts.dtype)
+                expanded[np.searchsorted(keys, self.species_keys)] = self.counts
+                self.species_keys, self.counts = keys, expanded
+        self.counts[np.searchsorted(self.species_keys, species_keys)] += counts
+        
+    def update(self, other):
+        # Adds the counts of another BeltCounts.
+        self.add_counts(other.species_keys, other.counts)
+        
+    def modes(self):
+        # Returns the most common belt of each species key. Ties go to the
+        # lowest belt, as they do with 'pd.Series.mode(x)[0]'.
+        return self.counts.argmax(axis=1) + 1
+    
+    def to_frame(self):
+        # Returns the mode and the count of each belt as a data frame indexed
+        # by species key.
+        df = pd.DataFrame(self.counts, columns=['Belt {} Count'.format(belt)
+            for belt in range(1, self.belts + 1)])
+        df.insert(0, 'Belt', self.modes())
+        df.index = pd.Index(self.species_keys, name='Species Key')
+        return df
+
 def classify(coord_uncertainty, x, y, raster_dataset, band, limit):
     # This function first filters an occurrence record based on its coordinate
     # uncertainty value then returns its pixel value using the supplied raster
@@ -87,6 +939,606 @@ def classify(coord_uncertainty, x, y, raster_dataset, band, limit):
             except IndexError:
                 pass
 
+class WindowedBand:
+    # This class gives read-only access to the first band of a raster file
+    # without loading it into memory. It can be indexed like the array returned
+    # by 'read(1)', with a pair of integers or of integer arrays. The band is
+    # read a block (strip or tile) at a time. The blocks of uncompressed
+    # GeoTIFFs are views of a memory map of the file; other blocks are read
+    # through an LRU cache holding at most 'cache_size' bytes. Array lookups are
+    # bucketed by block so that each block is read once per lookup.
+    
+    def __init__(self, path, cache_size):
+        self.path = path
+        self.cache_size = cache_size
+        self.dataset = rasterio.open(path)
+        self.shape = self.dataset.shape
+        self.dtype = np.dtype(self.dataset.dtypes[0])
+        self.block_height, self.block_width = self.dataset.block_shapes[0]
+        self.blocks_across = -(-self.shape[1] // self.block_width)
+        self.blocks = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.offsets = {}
+        self.file_map = self.memory_map()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def close(self):
+        self.file_map = None
+        self.blocks.clear()
+        self.dataset.close()
+        
+    def memory_map(self):
+        # Returns a memory map of the file if its band can be read from it
+        # directly, that is if it is a GeoTIFF holding a single uncompressed
+        # band of whole bytes, or None otherwise.
+        dataset = self.dataset
+        if (dataset.driver != 'GTiff' or dataset.compression is not None
+                or dataset.count != 1 or not os.path.isfile(self.path)
+                or 'NBITS' in dataset.tags(1, 'IMAGE_STRUCTURE')):
+            return None
+        with open(self.path, 'rb') as f:
+            byte_order = {b'II':'<', b'MM':'>'}.get(f.read(2))
+        if byte_order is None:
+            return None
+        self.file_dtype = self.dtype.newbyteorder(byte_order)
+        return np.memmap(self.path, dtype=np.uint8, mode='r')
+    
+    def mapped_block(self, i, j):
+        # Returns the block in block row 'i', column 'j' as a view of the memory
+        # map, or None if the file has no data for it (a sparse block). Tiles are
+        # stored whole, but the last strip may be short.
+        if (i, j) not in self.offsets:
+            self.offsets[i, j] = self.dataset.get_tag_item(
+                'BLOCK_OFFSET_{0}_{1}'.format(j, i), 'TIFF', bidx=1)
+        offset = self.offsets[i, j]
+        if not offset:
+            return None
+        height = self.block_height
+        if self.block_width == self.shape[1]:
+            height = min(height, self.shape[0] - i * self.block_height)
+        return np.ndarray((height, self.block_width), dtype=self.file_dtype,
+                          buffer=self.file_map, offset=int(offset))
+    
+    def read_block(self, i, j):
+        # Returns the block in block row 'i', column 'j'. Blocks that are not
+        # memory-mapped are cached, evicting the least recently used blocks to
+        # stay within the cache size.
+        if self.file_map is not None:
+            block = self.mapped_block(i, j)
+            if block is not None:
+                return block
+        key = (i, j)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        window = rasterio.windows.Window(j * self.block_width,
+            i * self.block_height, self.block_width, self.block_height)
+        window = window.intersection(rasterio.windows.Window(0, 0,
+            self.shape[1], self.shape[0]))
+        block = self.dataset.read(1, window=window)
+        while self.blocks and self.cached_bytes + block.nbytes > self.cache_size:
+            self.cached_bytes -= self.blocks.popitem(last=False)[1].nbytes
+        self.blocks[key] = block
+        self.cached_bytes += block.nbytes
+        return block
+    
+    def read_strip(self, i):
+        # Returns the rows of block row 'i' across the whole band, cropping the
+        # tiles stored whole past its edges.
+        height = min(self.block_height, self.shape[0] - i * self.block_height)
+        blocks = [self.read_block(i, j)[:height]
+                  for j in range(self.blocks_across)]
+        return np.hstack(blocks)[:, :self.shape[1]]
+    
+    def __getitem__(self, index):
+        # Negative indexes wrap around and other indexes out of bounds raise an
+        # IndexError, as they do for an array.
+        rows, cols = (np.asarray(i, dtype=np.int64) for i in index)
+        height, width = self.shape
+        if (np.any((rows < -height) | (rows >= height))
+                or np.any((cols < -width) | (cols >= width))):
+            raise IndexError('index out of bounds for raster band')
+        rows, cols = np.ravel(rows % height), np.ravel(cols % width)
+        bh, bw = self.block_height, self.block_width
+        values = np.empty(len(rows), dtype=self.dtype)
+        block_ids = rows // bh * self.blocks_across + cols // bw
+        order = np.argsort(block_ids, kind='stable')
+        block_ids = block_ids[order]
+        starts = np.flatnonzero(np.diff(block_ids, prepend=-1))
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            i, j = divmod(int(block_ids[start]), self.blocks_across)
+            block = self.read_block(i, j)
+            indexes = order[start:end]
+            values[indexes] = block[rows[indexes] - i * bh,
+                                    cols[indexes] - j * bw]
+        if np.ndim(index[0]) == 0 and np.ndim(index[1]) == 0:
+            return values[0]
+        return values
+
+def parse_floats(values):
+    # This function converts an array of strings to floats. Values that cannot
+    # be parsed become NaN.
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+
+def parse_coordinates(coord_uncertainty, x, y):
+    # This function parses arrays of coordinate uncertainty and coordinate
+    # strings the way 'classify' does: a missing coordinate uncertainty counts
+    # as zero and values that cannot be parsed become NaN.
+    coord_uncertainty = pd.Series(coord_uncertainty).replace('', '0')
+    return parse_floats(coord_uncertainty), parse_floats(x), parse_floats(y)
+
+def locate_coordinates(coord_uncertainty, x, y, transform, shape, limit):
+    # This function returns the indexes of the records in arrays of floats that
+    # 'classify' would look up in a raster of the given shape and affine
+    # transform, with the rows and columns of their pixels.
+    valid = (coord_uncertainty <= limit) & np.isfinite(x) & np.isfinite(y)
+    indexes = np.flatnonzero(valid)
+    rows, cols = rasterio.transform.rowcol(transform, x[indexes], y[indexes])
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    # Negative indexes wrap around, as they do when indexing 'band' directly.
+    height, width = shape
+    inside = ((rows >= -height) & (rows < height)
+              & (cols >= -width) & (cols < width))
+    return indexes[inside], rows[inside] % height, cols[inside] % width
+
+def classify_coordinates(coord_uncertainty, x, y, transform, band, limit):
+    # This function is a vectorized version of 'classify' for arrays of floats
+    # in which NaN marks unparseable values. The raster is given by its affine
+    # transform. Returns an array of pixel values in which unclassified records
+    # are zero.
+    indexes, rows, cols = locate_coordinates(coord_uncertainty, x, y,
+        transform, band.shape, limit)
+    pixel_vals = band[rows, cols]
+    belts = np.zeros(len(x), dtype=band.dtype)
+    belts[indexes] = np.where(pixel_vals != 0, pixel_vals - 10, 0)
+    return belts
+
+def classify_cells(species_keys, coord_uncertainty, x, y, transform, band,
+                   limit):
+    # This function collapses occurrences to unique (species key, raster row,
+    # column) cells, classifies each cell once and returns the species keys,
+    # belts and occurrence counts of the classified cells. Occurrences without
+    # a species key are dropped, as they are when aggregating.
+    indexes, rows, cols = locate_coordinates(coord_uncertainty, x, y,
+        transform, band.shape, limit)
+    species_keys = pd.Series(species_keys).iloc[indexes]
+    known = species_keys.notna().to_numpy()
+    species_codes, species_keys = pd.factorize(
+        species_keys[known].to_numpy(dtype=np.int64))
+    height, width = band.shape
+    # Codes of the cells, which fit in 64 bits as there are no more species
+    # than occurrences.
+    cells = (species_codes * height + rows[known]) * width + cols[known]
+    cell_codes, cells = pd.factorize(cells)
+    counts = np.bincount(cell_codes, minlength=len(cells))
+    species_keys = species_keys[cells // (height * width)]
+    pixel_vals = band[cells // width % height, cells % width]
+    belts = np.where(pixel_vals != 0, pixel_vals - 10, 0).astype(band.dtype)
+    classified = belts != 0
+    return species_keys[classified], belts[classified], counts[classified]
+
+# Mean radius of the Earth in meters.
+EARTH_RADIUS = 6371008.8
+
+def build_belt_tables(band, path):
+    # This function writes the summed-area table of each belt of a band to a
+    # NumPy file, as an array in which element [i, j, b] is the number of
+    # pixels of belt b + 1 above row i and left of column j. The pixels of each
+    # belt in any window can then be counted with four lookups. The band is a
+    # WindowedBand, summed a strip of blocks at a time onto the last row of
+    # the tables written so far, so that only the file (28 bytes per pixel)
+    # grows with the raster. Yields the rows done after each strip.
+    height, width = band.shape
+    tables = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint32,
+        shape=(height + 1, width + 1, BeltCounts.belts))
+    for i in range(-(-height // band.block_height)):
+        strip = band.read_strip(i)
+        start = i * band.block_height
+        end = start + len(strip)
+        for belt in range(1, BeltCounts.belts + 1):
+            table = np.cumsum(strip == belt + 10, axis=0, dtype=np.uint32)
+            np.cumsum(table, axis=1, out=table)
+            table += tables[start, 1:, belt - 1]
+            tables[start + 1:end + 1, 1:, belt - 1] = table
+        yield end
+    tables.flush()
+
+def load_belt_tables(path):
+    # This function memory-maps the tables written by 'build_belt_tables'.
+    return np.load(path, mmap_mode='r')
+
+def count_window(tables, rows, cols):
+    # This function returns the pixels of each belt in windows given by arrays
+    # of first and last (exclusive) rows and columns. The unsigned differences
+    # wrap around, so they are exact.
+    (r0, r1), (c0, c1) = rows, cols
+    return (tables[r1, c1] - tables[r0, c1]) - (tables[r1, c0] - tables[r0, c0])
+
+def count_belts_in_radius(coord_uncertainty, x, y, transform, tables, limit):
+    # This function counts the pixels of each belt within the coordinate
+    # uncertainty of each record, in the window of pixels covering the square
+    # that bounds the circle of that radius, using the tables written by
+    # 'build_belt_tables'. The raster must be in geographic coordinates and
+    # wraps around at the antimeridian if it spans all longitudes. Records
+    # with a coordinate uncertainty above 'limit' or outside the raster are
+    # left out. Returns the indexes of the other records and an array with a
+    # row of counts for each.
+    height, width = tables.shape[0] - 1, tables.shape[1] - 1
+    inverse = ~transform
+    valid = (coord_uncertainty <= limit) & np.isfinite(x) & np.isfinite(y)
+    indexes = np.flatnonzero(valid)
+    cols, rows = (np.floor(v) for v in inverse * (x[indexes], y[indexes]))
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    indexes = indexes[inside]
+    radius = np.maximum(coord_uncertainty[indexes], 0)
+    x, y = x[indexes], y[indexes]
+    dlat = np.degrees(radius / EARTH_RADIUS)
+    with np.errstate(divide='ignore'):
+        dlon = np.minimum(dlat / np.cos(np.radians(y)), 180)
+    cols_a, rows_a = inverse * (x - dlon, y + dlat)
+    cols_b, rows_b = inverse * (x + dlon, y - dlat)
+    r0 = np.floor(np.minimum(rows_a, rows_b)).astype(np.int64)
+    r1 = np.floor(np.maximum(rows_a, rows_b)).astype(np.int64) + 1
+    c0 = np.floor(np.minimum(cols_a, cols_b)).astype(np.int64)
+    c1 = np.floor(np.maximum(cols_a, cols_b)).astype(np.int64) + 1
+    rows = np.clip(r0, 0, height), np.clip(r1, 0, height)
+    counts = None
+    if np.isclose(abs(transform.a) * width, 360):
+        # Windows across the antimeridian are split in two.
+        whole = c1 - c0 >= width
+        c0, c1 = np.where(whole, 0, c0), np.where(whole, width, c1)
+        cols = (np.where(c0 < 0, c0 + width, 0),
+                np.where(c0 < 0, width, np.maximum(c1 - width, 0)))
+        counts = count_window(tables, rows, cols)
+    cols = np.clip(c0, 0, width), np.clip(c1, 0, width)
+    if counts is None:
+        return indexes, count_window(tables, rows, cols)
+    return indexes, counts + count_window(tables, rows, cols)
+
+def classify_batch(coord_uncertainty, x, y, transform, band, limit):
+    # This function is a vectorized version of 'classify' for arrays of
+    # strings. Returns an array of pixel values in which unclassified records
+    # are zero.
+    args = parse_coordinates(coord_uncertainty, x, y)
+    return classify_coordinates(*args, transform, band, limit)
+
+def read_occurrence_blocks(binary, block_size):
+    # This function splits an open GBIF occurrence file into blocks of whole
+    # lines of roughly 'block_size' bytes. The header is skipped.
+    binary.readline()
+    while True:
+        lines = binary.readlines(block_size)
+        if not lines:
+            break
+        yield b''.join(lines)
+
+def parse_occurrence_block(block):
+    # This function parses a block of tab-delimited occurrence records into a
+    # data frame of strings holding only the columns needed for classification.
+    columns = OCCURRENCE_COLUMNS
+    try:
+        df = pd.read_csv(io.BytesIO(block), sep='\t', header=None,
+            usecols=list(columns.values()), dtype=str, na_filter=False,
+            quoting=csv.QUOTE_NONE, encoding='utf-8')
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame(columns=list(columns.values()), dtype=str)
+    return df.rename(columns={v:k for k, v in columns.items()})
+
+def classify_block(block, transform, band, limit, dedupe=False,
+                   radius=False):
+    # This function classifies a block of occurrence records and returns the
+    # classified species keys as lines of text. With 'dedupe', the lines hold
+    # the species keys, belts and counts of the classified cells instead. With
+    # 'radius', 'band' is the belt tables and the lines hold the species keys
+    # and the pixels of each belt within the coordinate uncertainty.
+    df = parse_occurrence_block(block)
+    if radius:
+        args = parse_coordinates(df['coord_uncertainty'], df['x'], df['y'])
+        indexes, pixels = count_belts_in_radius(*args, transform, band, limit)
+        classified = pixels.any(axis=1)
+        lines = df['skey'].iloc[indexes[classified]].reset_index(drop=True)
+        for column in pixels[classified].T:
+            lines = lines + ',' + pd.Series(column).astype(str)
+        return ''.join(lines + '\n')
+    if dedupe:
+        skeys = pd.to_numeric(df['skey'], errors='coerce')
+        args = parse_coordinates(df['coord_uncertainty'], df['x'], df['y'])
+        columns = classify_cells(skeys, *args, transform, band, limit)
+        lines = [pd.Series(column).astype(str) for column in columns]
+        return ''.join(lines[0] + ',' + lines[1] + ',' + lines[2] + '\n')
+    belts = classify_batch(df['coord_uncertainty'], df['x'], df['y'],
+        transform, band, limit)
+    classified = belts != 0
+    skeys = df['skey'][classified]
+    lines = skeys + ',' + belts[classified].astype(str) + '\n'
+    return ''.join(lines)
+
+def count_block(block, transform, band, limit, dedupe=False, radius=False):
+    # This function classifies a block of occurrence records and returns the
+    # counts of the classified species keys by belt. With 'dedupe', each cell
+    # is classified once and counted as many times as it occurs. With
+    # 'radius', each occurrence is shared among the belts within its
+    # coordinate uncertainty.
+    df = parse_occurrence_block(block)
+    skeys = pd.to_numeric(df['skey'], errors='coerce')
+    if radius:
+        args = parse_coordinates(df['coord_uncertainty'], df['x'], df['y'])
+        indexes, pixels = count_belts_in_radius(*args, transform, band, limit)
+        counts = BeltCounts(fractional=True)
+        counts.add_distributions(skeys.iloc[indexes], *pixels.T)
+        return counts
+    counts = BeltCounts()
+    if dedupe:
+        args = parse_coordinates(df['coord_uncertainty'], df['x'], df['y'])
+        counts.add(*classify_cells(skeys, *args, transform, band, limit))
+        return counts
+    belts = classify_batch(df['coord_uncertainty'], df['x'], df['y'],
+        transform, band, limit)
+    classified = belts != 0
+    counts.add(skeys[classified], belts[classified])
+    return counts
+
+def map_bounded(executor, fn, iterable, max_pending):
+    # This function is like 'executor.map' but submits no more than
+    # 'max_pending' calls ahead of the results consumed. Results are yielded in
+    # the order of 'iterable'.
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def map_as_completed(executor, fn, iterable, max_ready):
+    # This function calls 'fn' on each item in 'executor' and yields (item,
+    # result) pairs in the order the calls complete. Items are taken from
+    # 'iterable' on a thread of its own as they come, so it may be slow to
+    # produce them, as 'poll_download_links' is. Results wait for the consumer
+    # in a queue of at most 'max_ready' pairs, and a call whose result finds
+    # the queue full holds its worker until there is room, so that no more
+    # than 'max_ready' results plus one per worker are ever ahead of the
+    # consumer. An exception raised by 'fn' or 'iterable' is raised here. Once
+    # the generator is closed, no more items are taken and calls that have not
+    # started are skipped.
+    ready = queue.Queue(max_ready)
+    stop = threading.Event()
+    end = object() # Marks the number of items, once they have all been taken.
+    futures = []
+    
+    def put(entry):
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def call(item):
+        if stop.is_set():
+            return
+        try:
+            put((item, fn(item), None))
+        except Exception as e:
+            put((item, None, e))
+    
+    def submit():
+        count = 0
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                futures.append(executor.submit(call, item))
+                count += 1
+        except Exception as e:
+            put((end, None, e))
+        else:
+            put((end, count, None))
+    
+    threading.Thread(target=submit, daemon=True).start()
+    count = None
+    completed = 0
+    try:
+        while count is None or completed < count:
+            item, result, error = ready.get()
+            if error is not None:
+                raise error
+            if item is end:
+                count = result
+                continue
+            completed += 1
+            yield item, result
+    finally:
+        stop.set()
+        for future in list(futures):
+            future.cancel()
+
+_worker_state = {}
+
+def init_classification_worker(band, transform, limit):
+    # This function runs once in each classification worker process. The band
+    # is either the path to a NumPy file, which is memory-mapped so that the
+    # workers share it instead of copying it, or the arguments of a
+    # WindowedBand, which each worker opens with a block cache of its own.
+    if isinstance(band, str):
+        band = np.load(band, mmap_mode='r')
+    else:
+        band = WindowedBand(*band)
+    _worker_state['band'] = band
+    _worker_state['transform'] = transform
+    _worker_state['limit'] = limit
+
+def convert_occurrence_block(block):
+    # This function converts a block of occurrence records to an Arrow table
+    # holding only the columns needed for classification, typed and parsed the
+    # way 'classify' parses them.
+    df = parse_occurrence_block(block)
+    coord_uncertainty, x, y = parse_coordinates(df['coord_uncertainty'],
+        df['x'], df['y'])
+    species_key = pd.to_numeric(df['skey'], errors='coerce').astype('Int64')
+    columns = {'decimalLatitude':y,
+               'decimalLongitude':x,
+               'coordinateUncertaintyInMeters':coord_uncertainty,
+               'speciesKey':pa.array(species_key, type=pa.int64())}
+    return pa.table(columns, schema=get_schema('occurrences'))
+
+def classify_table(table, transform, band, limit, dedupe=False,
+                   radius=False):
+    # This function classifies a table (or record batch) of occurrences in the
+    # format written by 'convert_occurrence_block' and returns a table of the
+    # classified species keys. With 'dedupe', the table holds the species
+    # keys, belts and counts of the classified cells instead. With 'radius',
+    # it holds the species keys and the pixels of each belt within the
+    # coordinate uncertainty, like 'classify_block'.
+    coord_uncertainty, x, y = [table.column(name).to_numpy()
+        for name in ['coordinateUncertaintyInMeters', 'decimalLongitude',
+                     'decimalLatitude']]
+    if radius:
+        indexes, pixels = count_belts_in_radius(coord_uncertainty, x, y,
+            transform, band, limit)
+        classified = pixels.any(axis=1)
+        schema = get_schema('belt-distributions')
+        columns = [table.column('speciesKey').take(indexes[classified])]
+        columns += list(pixels[classified].T)
+        return pa.table(dict(zip(schema.names, columns)), schema=schema)
+    if dedupe:
+        skeys = table.column('speciesKey').to_pandas()
+        columns = classify_cells(skeys, coord_uncertainty, x, y, transform,
+            band, limit)
+        schema = get_schema('classified-cells')
+        return pa.table(dict(zip(schema.names, columns)), schema=schema)
+    belts = classify_coordinates(coord_uncertainty, x, y, transform, band,
+        limit)
+    classified = belts != 0
+    columns = {'Species Key':table.column('speciesKey').filter(classified),
+               'Belt':belts[classified]}
+    return pa.table(columns, schema=get_schema('classifications'))
+
+def count_table(table, transform, band, limit, dedupe=False, radius=False):
+    # This function classifies a table of occurrences like 'classify_table'
+    # and returns the counts of the classified species keys by belt.
+    table = classify_table(table, transform, band, limit, dedupe, radius)
+    columns = [column.to_numpy(zero_copy_only=False)
+               for column in table.columns]
+    if radius:
+        counts = BeltCounts(fractional=True)
+        counts.add_distributions(*columns)
+        return counts
+    counts = BeltCounts()
+    counts.add(*columns)
+    return counts
+
+def classify_in_worker(classify_fn, block):
+    # This function classifies a block of occurrence records with one of the
+    # classify_block, classify_table, count_block or count_table functions in a
+    # worker process set up by 'init_classification_worker'.
+    return classify_fn(block, _worker_state['transform'],
+        _worker_state['band'], _worker_state['limit'])
+
+@contextlib.contextmanager
+def classification_pool(transform, band, limit, workers):
+    # This function starts a pool of 'workers' processes set up by
+    # 'init_classification_worker' to classify against 'band', which can be
+    # used for many calls of 'classify_in_pool'.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if isinstance(band, np.memmap):
+            band = band.filename # Already on disk, like the belt tables.
+        elif isinstance(band, np.ndarray):
+            path_to_band = os.path.join(tmpdir, 'band.npy')
+            np.save(path_to_band, band)
+            band = path_to_band
+        else:
+            band = (band.path, band.cache_size)
+        initargs = (band, transform, limit)
+        with ProcessPoolExecutor(workers, initializer=init_classification_worker,
+                                 initargs=initargs) as executor:
+            yield executor
+
+def classify_in_pool(executor, classify_fn, blocks, workers):
+    # This function classifies blocks of occurrence records in a pool started
+    # by 'classification_pool' and yields the results in the order of 'blocks'.
+    fn = functools.partial(classify_in_worker, classify_fn)
+    return map_bounded(executor, fn, blocks, 2 * workers)
+
+def classify_blocks_in_parallel(classify_fn, blocks, transform, band, limit,
+                                workers):
+    # This function classifies blocks of occurrence records in a pool of
+    # 'workers' processes and yields the results in the order of 'blocks'.
+    with classification_pool(transform, band, limit, workers) as executor:
+        yield from classify_in_pool(executor, classify_fn, blocks, workers)
+
+def is_download_running(session, url, timeout):
+    # This function checks whether a GBIF occurrence download is still being
+    # prepared. A download that is not found does not count as running, but
+    # one whose status cannot be read for any other reason does.
+    r = session.get(url, stream=False, timeout=timeout)
+    if r.status_code == requests.codes.not_found:
+        return False
+    if r.status_code != requests.codes.ok:
+        return True
+    return r.json()['status'] in ['PREPARING', 'RUNNING', 'SUSPENDED']
+
+def submit_download_requests(session, url, species_keys, timeout,
+                             max_chunk_size, max_running, delay, max_delay,
+                             running=()):
+    # This function submits GBIF occurrence download requests for a list of
+    # species keys and yields (species keys, download ID) pairs as each one is
+    # accepted. No more than 'max_running' downloads, counting the IDs in
+    # 'running', are kept running at once. When that many are, they are polled,
+    # backing off from 'delay' to 'max_delay' seconds, until one finishes. A 420
+    # or 429 response means that the quota is full. The keys are split evenly
+    # into chunks of up to 'max_chunk_size' keys, and into at least as many
+    # chunks as may run at once. The chunks still to be submitted are split
+    # again, into chunks of at most half the size, whenever a request is
+    # rejected as too large.
+    status_url = url + 'occurrence/download/'
+    running = [download_id for download_id in running
+               if is_download_running(session, status_url + download_id,
+                                      timeout)]
+    limit = max_running
+    current_delay = delay
+    start = 0
+    chunks = max(math.ceil(len(species_keys) / max_chunk_size), max_running)
+    size = math.ceil(len(species_keys) / chunks) if species_keys else 0
+    while start < len(species_keys):
+        if len(running) >= limit:
+            time.sleep(current_delay)
+            count = len(running)
+            running = [download_id for download_id in running
+                       if is_download_running(session,
+                                              status_url + download_id, timeout)]
+            if len(running) < count:
+                current_delay = delay
+            else:
+                current_delay = min(current_delay * 1.5, max_delay)
+            if len(running) < count or not running:
+                limit = max_running
+            continue
+        chunk = species_keys[start:start + size]
+        payload = generate_query_expression(chunk)
+        r = session.post(url + 'occurrence/download/request', json=payload,
+                         timeout=timeout)
+        if r.status_code == requests.codes.created:
+            download_id = r.text
+            running.append(download_id)
+            start += size
+            yield chunk, download_id
+        elif r.status_code in [420, 429]:
+            limit = len(running)
+        elif r.status_code in [400, 413] and size > 1:
+            remaining = len(species_keys) - start
+            size = math.ceil(remaining / math.ceil(remaining / (size // 2)))
+        else:
+            raise Exception('Download Request Failed: {0} {1}'.format(
+                r.status_code, r.text))
+
 def get_download_link(session, url, timeout):
     # This function checks the status of a GBIF occurrence download request.
     r = session.get(url, stream=False, timeout=timeout)
@@ -101,11 +1553,127 @@ def get_download_link(session, url, timeout):
         else:
             raise Exception('Download Request Failed: ' + status)
     
+def get_expected_size(r, offset):
+    # This function returns the full size of a file from the headers of a
+    # (possibly partial) response, or None if the server does not say.
+    content_range = r.headers.get('Content-Range')
+    if content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', maxsplit=1)[1])
+    if 'Content-Length' in r.headers:
+        if r.status_code == requests.codes.ok:
+            return int(r.headers['Content-Length'])
+        if r.status_code == requests.codes.partial_content:
+            return offset + int(r.headers['Content-Length'])
+
+def verify_md5(path, content_md5):
+    # This function checks a file against the base64-encoded MD5 digest of a
+    # Content-MD5 header.
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode() == content_md5
+
+def download_file(session, url, path, timeout, chunk_size, attempts):
+    # This function downloads a file to 'path' through a '.part' file. If the
+    # transfer is interrupted it is resumed with an HTTP Range request, here or
+    # on a later call. The file only counts as done, and is renamed to 'path',
+    # once its size (and MD5 digest, if the server sends one) has been checked.
+    if os.path.exists(path):
+        return path
+    part_path = path + '.part'
+    for attempt in range(attempts):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Offsets and sizes are those of the file as stored, not compressed.
+        headers = {'Accept-Encoding':'identity'}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=timeout) as r:
+                expected_size = get_expected_size(r, offset)
+                content_md5 = None
+                if r.status_code != requests.codes.range_not_satisfiable:
+                    # Otherwise the partial file is already complete.
+                    r.raise_for_status()
+                    if r.status_code == requests.codes.ok:
+                        content_md5 = r.headers.get('Content-MD5')
+                    resumed = r.status_code == requests.codes.partial_content
+                    with open(part_path, 'ab' if resumed else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size):
+                            f.write(chunk)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            continue
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            if size > expected_size:
+                os.remove(part_path)
+            continue
+        if content_md5 and not verify_md5(part_path, content_md5):
+            os.remove(part_path)
+            continue
+        os.replace(part_path, path)
+        return path
+    raise Exception('Unable to download: ' + url)
+
+def strip_zip64_extra(extra):
+    # This function removes any Zip64 extended information fields from the
+    # extra data of a zip archive member.
+    fields = []
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id != 1:
+            fields.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return b''.join(fields)
+
+def poll_download_links(session, urls, timeout, delay, max_delay, max_polls):
+    # This function polls a list of GBIF occurrence download requests together
+    # and yields (index, download link) pairs as each one succeeds. Every
+    # request has its own schedule, with the delay between polls growing by
+    # half after each unsuccessful poll, up to 'max_delay' seconds.
+    schedule = [(time.monotonic(), i, delay, 1) for i in range(len(urls))]
+    heapq.heapify(schedule)
+    while schedule:
+        due, i, current_delay, polls = heapq.heappop(schedule)
+        time.sleep(max(0, due - time.monotonic()))
+        download_link = get_download_link(session, urls[i], timeout)
+        if download_link:
+            yield i, download_link
+        elif polls >= max_polls:
+            raise Exception('Unable to get download link.')
+        else:
+            due = time.monotonic() + current_delay
+            next_delay = min(current_delay * 1.5, max_delay)
+            heapq.heappush(schedule, (due, i, next_delay, polls + 1))
+
 def copy_stream(stream, target_archive):
     # This function copies the contents of a zipped GBIF occurrence download to
-    # a consolidated archive.
+    # a consolidated archive. The member's compressed data is copied as is, so
+    # it is never decompressed or held in memory. ZipFile has no public API for
+    # this, so the local file header is written the way ZipFile.write does.
     with ZipFile(stream) as source_archive:
         zip_info = source_archive.infolist()[0]
-        with source_archive.open(zip_info) as source_file:
-            with target_archive.open(zip_info, 'w') as target_file:
-                shutil.copyfileobj(source_file, target_file)
\ No newline at end of file
+    stream.seek(zip_info.header_offset)
+    header = stream.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    stream.seek(name_length + extra_length, io.SEEK_CUR)
+    
+    target_info = copy.copy(zip_info)
+    target_info.flag_bits &= ~0x08 # Sizes are known, so no data descriptor.
+    target_info.extra = strip_zip64_extra(zip_info.extra)
+    target = target_archive.fp
+    target_info.header_offset = target.tell()
+    target.write(target_info.FileHeader(None))
+    remaining = zip_info.compress_size
+    while remaining:
+        chunk = stream.read(min(remaining, 2**20))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated member: ' + zip_info.filename)
+        target.write(chunk)
+        remaining -= len(chunk)
+    target_archive.start_dir = target.tell()
+    target_archive.filelist.append(target_info)
+    target_archive.NameToInfo[target_info.filename] = target_info
+    target_archive._didModify = True